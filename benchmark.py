@@ -0,0 +1,665 @@
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+import transform_data as td
+
+
+# Synthetic tables shaped like the OWID covid tables (indexed by country, date), so the
+# pipeline can be checked and timed without network access to the catalog.
+#--------------------------------
+
+# country_names: optional names to use (e.g. the shapefile's ADMIN names, so the countries show on the map),
+# completed with generated names when there are fewer than n_countries.
+def make_synthetic_tables(n_countries = 50, n_days = 1000, seed = 0, country_names = None):
+    rng = np.random.default_rng(seed)
+    dates = pd.date_range('2020-01-01', periods=n_days, freq='D')
+    if country_names is None:
+        country_names = []
+    generated_names = [f"{'Land' if i % 2 else 'Zone'} {i:03d}" for i in range(max(n_countries - len(country_names), 0))]
+    countries = (list(country_names) + generated_names)[:n_countries] + ['Africa', 'Oceania', 'World']
+
+    cd_frames, vac_frames = [], []
+    t = np.arange(n_days)
+    for c, country in enumerate(countries):
+
+        # Cases and deaths: a few waves with noise, deaths following cases with a lag.
+        wave = sum(np.exp(-0.5 * ((t - rng.uniform(0, n_days)) / rng.uniform(20, 80))**2) for _ in range(3))
+        cases = rng.poisson(rng.uniform(100, 20000) * wave).astype(float)
+        deaths = rng.poisson(0.02 * np.roll(cases, rng.integers(5, 25))).astype(float)
+
+        # weekly reporting: six zeros followed by the week's total.
+        if c % 3 == 0:
+            start = rng.integers(0, n_days // 2)
+            for j in range(start, min(start + 200, n_days) - 6, 7):
+                cases[j + 6] = cases[j:j + 7].sum()
+                cases[j:j + 6] = 0
+                deaths[j + 6] = deaths[j:j + 7].sum()
+                deaths[j:j + 6] = 0
+
+        # anomalous spike: a reclassification posted on one day.
+        if c % 4 == 0:
+            cases[rng.integers(0, n_days)] = cases.max() * 20
+            deaths[rng.integers(0, n_days)] = deaths.max() * 20
+
+        # missing values at the start of the series.
+        cases[:rng.integers(0, 30)] = np.nan
+        deaths[:rng.integers(0, 30)] = np.nan
+        total_deaths = np.nancumsum(deaths) * 1e6 / rng.uniform(1e6, 1e8)
+
+        cd_frames.append(pd.DataFrame({'country': country, 'date': dates, 'new_cases': cases,
+                                       'new_deaths': deaths, 'total_deaths_per_million': total_deaths}))
+
+        # Vaccination: logistic rollout, NaN before it starts.
+        start = rng.integers(n_days // 4, n_days // 2)
+        rate = rng.uniform(0.01, 0.05)
+        full = 100 * rng.uniform(0.4, 0.95) / (1 + np.exp(-rate * (t - start - 100)))
+        boosters = 100 * rng.uniform(0.1, 0.8) / (1 + np.exp(-rate * (t - start - 250)))
+        daily = np.gradient(full)
+        full[:start], boosters[:start + 100], daily[:start] = np.nan, np.nan, np.nan
+
+        # anomalous non-zeros: values reported before any vaccines were administered.
+        if c % 2 == 0:
+            full[start - 20:start - 10] = rng.uniform(1, 5)
+            boosters[start + 60:start + 70] = rng.uniform(1, 5)
+
+        vac_frames.append(pd.DataFrame({'country': country, 'date': dates,
+                                        'daily_people_vaccinated_smoothed_per_hundred': daily,
+                                        'people_fully_vaccinated_per_hundred': full,
+                                        'total_boosters_per_hundred': boosters}))
+
+    tb_country_cases_deaths = pd.concat(cd_frames).set_index(['country', 'date']).sort_index()
+    tb_country_vac = pd.concat(vac_frames).set_index(['country', 'date']).sort_index()
+    return tb_country_cases_deaths, tb_country_vac
+
+
+# Reference cleaning: the original per-country loops
+#--------------------------------
+# Each correction filters and copies one country's rows, and writes them back with a full-frame mask.
+# The grouped engine of transform_data is checked (test_transform_data.py) and timed against these.
+
+def reference_process_covid_data(tb_country_cases_deaths, tb_country_vac):
+    df_cd = td.basic_processing(tb_country_cases_deaths, td.features_cd)
+    df_cd = reference_correct_weekly_reporting_in_daily(df_cd)
+    df_cd = reference_correct_anomalous_spike(df_cd)
+    df_vac = td.basic_processing(tb_country_vac, td.features_vac, True)
+    df_vac = reference_correct_anomalous_nonzeros(df_vac)
+    return df_cd, df_vac
+
+
+def reference_correct_anomalous_spike(df):
+    # Get list of unique countries
+    country_list = df['country'].unique()
+    
+    for country in country_list:
+        # Select rows corresponding to the current country
+        df_country = df[df['country'] == country].copy()  # Avoid modifying a slice of df
+
+        # Correct 'people_fully_vaccinated_per_hundred'
+        df_cases = df_country['new_cases']
+        df_deaths = df_country['new_deaths']
+
+        # Get the 10 largest values and calculate their mean
+        top_10_cases_mean = round(df_cases.nlargest(10).mean())
+        top_10_deaths_mean = round(df_deaths.nlargest(10).mean())
+
+        # Identify values that are more than 10 times the mean of the top 10 largest values
+        scalar = 5
+        high_cases = df_cases > scalar * top_10_cases_mean
+        high_deaths = df_deaths > scalar * top_10_deaths_mean
+
+        # Correct the values by setting them to the mean of the top 10 largest values
+        df_country.loc[high_cases, 'new_cases'] = top_10_cases_mean
+        df_country.loc[high_deaths, 'new_deaths'] = top_10_deaths_mean
+
+        # Reassign the corrected values back to the original dataframe
+        df.loc[df['country'] == country, 'new_cases'] = df_country['new_cases']
+        df.loc[df['country'] == country, 'new_deaths'] = df_country['new_deaths']
+
+    return df
+    
+
+# anomalous non-zeros: when the vaccinations or boosters have periods of non-zero values before any vaccines were administered.
+def reference_correct_anomalous_nonzeros(df):
+    # Get list of unique countries
+    country_list = df['country'].unique()
+    
+    for country in country_list:
+        # Select rows corresponding to the current country
+        df_vac_country = df[df['country'] == country].copy()  # Avoid modifying a slice of df
+
+        # Correct 'people_fully_vaccinated_per_hundred'
+        df_vac_p100 = df_vac_country['people_fully_vaccinated_per_hundred']
+        decreasing_mask_vac = df_vac_p100 < df_vac_p100.cummax()
+        if decreasing_mask_vac.any(): 
+        
+            # Get the two indices between which values will be set to zero
+            first_decrease_index_vac = decreasing_mask_vac.idxmax()
+            first_country_ind = df.loc[df['country'] == country].index[0]  # Get first index for country
+        
+            # Set 'people_fully_vaccinated_per_hundred' to 0 for indices from first_country_ind to first_decrease_index_vac
+            df.loc[(first_country_ind <= df.index) & (df.index < first_decrease_index_vac), 'people_fully_vaccinated_per_hundred'] = 0
+
+
+        # Correct 'total_boosters_per_hundred'
+        df_boosters_p100 = df_vac_country['total_boosters_per_hundred']
+        decreasing_mask_boost = df_boosters_p100 < df_boosters_p100.cummax()
+        if decreasing_mask_boost.any(): 
+
+            # get the two index between which values will be set to zero.
+            first_decrease_index_boost = decreasing_mask_boost.idxmax()
+            first_country_ind = df.loc[df['country'] == country].index[0]  # Get first index for 'India'
+
+            # Set 'total_boosters_per_hundred' to 0 for indices from ind to ind + 99
+            df.loc[(first_country_ind <= df.index) & (df.index < first_decrease_index_boost), 'total_boosters_per_hundred'] = 0
+
+    return df
+
+
+# Sometimes countries will post the cumulative days data on one day of the week.
+# mean method in use.
+def reference_correct_weekly_reporting_in_daily(df):
+    # Get list of unique countries
+    country_list = df['country'].unique()
+
+    # Go through country list
+    for country in country_list:
+        df_country = df[df['country'] == country].copy()
+        
+        # Cases and deaths data
+        df_country_cases = df_country['new_cases']
+        df_country_deaths = df_country['new_deaths']
+        
+        # Create a boolean mask for six consecutive zeros followed by a non-zero value for 'new_cases'
+        mask_cases = (df_country_cases.shift(1) == 0) & (df_country_cases.shift(2) == 0) & (df_country_cases.shift(3) == 0) & \
+                     (df_country_cases.shift(4) == 0) & (df_country_cases.shift(5) == 0) & \
+                     (df_country_cases.shift(6) == 0) & (df_country_cases != 0)
+        
+        # Create a boolean mask for six consecutive zeros followed by a non-zero value for 'new_deaths'
+        mask_deaths = (df_country_deaths.shift(1) == 0) & (df_country_deaths.shift(2) == 0) & (df_country_deaths.shift(3) == 0) & \
+                      (df_country_deaths.shift(4) == 0) & (df_country_deaths.shift(5) == 0) & \
+                      (df_country_deaths.shift(6) == 0) & (df_country_deaths != 0)
+
+        
+        # Get the indices where the pattern matches for cases and deaths
+        indices_cases = mask_cases.index[mask_cases].tolist() - df_country_cases.index[0]
+        indices_deaths = mask_deaths.index[mask_deaths].tolist() - df_country_deaths.index[0]
+
+        # cases
+        # For each index in cases, modify the `new_cases` values in the range j to j+5
+        new_cases_col = df_country_cases.copy()
+        for j in indices_cases:
+            if j + 6 < len(df_country_cases):  # Ensure j+6 is within bounds
+                new_cases_col.iloc[j:j+6] = round(np.mean(df_country_cases.iloc[j:j+6]))
+        
+        # Now assign the new_cases_col to the original DataFrame
+        df.loc[(df['country'] == country), 'new_cases'] = new_cases_col
+
+        
+        # deaths
+        # For each index in deaths, modify the `new_deaths` values in the range j to j+5
+        new_deaths_col = df_country_deaths.copy()
+        for j in indices_deaths:
+            if j + 6 < len(df_country_deaths):  # Ensure j+6 is within bounds
+                new_deaths_col.iloc[j:j+6] = round(np.mean(df_country_deaths.iloc[j:j+6]))
+
+        # Now assign the new_deaths_col to the original DataFrame
+        df.loc[(df['country'] == country), 'new_deaths'] = new_deaths_col
+
+    return df
+
+
+# Timing and memory of the cleaning engines
+#--------------------------------
+
+def time_cleaning(tb_country_cases_deaths, tb_country_vac, repeat = 3):
+    timings = {}
+    for name, process in [('loop', reference_process_covid_data), ('grouped', td.process_covid_data)]:
+        best = np.inf
+        for _ in range(repeat):
+            start = time.perf_counter()
+            process(tb_country_cases_deaths, tb_country_vac)
+            best = min(best, time.perf_counter() - start)
+        timings[name] = best
+    return timings
+
+
+# peak memory (MB, from tracemalloc) allocated by the corrections of the original loops and of the grouped
+# engine, starting from the frames of basic_processing, next to the size of those frames (the target:
+# the corrections should take at most about one copy of the tables).
+def measure_cleaning_memory(tb_country_cases_deaths, tb_country_vac):
+    import tracemalloc
+
+    df_cd = td.basic_processing(tb_country_cases_deaths, td.features_cd)
+    df_vac = td.basic_processing(tb_country_vac, td.features_vac, True)
+    engines = {
+        'loop': (lambda df: reference_correct_anomalous_spike(reference_correct_weekly_reporting_in_daily(df)),
+                 reference_correct_anomalous_nonzeros),
+        'grouped': (td.correct_cases_deaths_by_country, td.correct_anomalous_nonzeros),
+    }
+    memory = {}
+    for name, (correct_cd, correct_vac) in engines.items():
+        cd, vac = df_cd.copy(), df_vac.copy()  # the loops write into the frames they are given
+        tracemalloc.start()
+        cd, vac = correct_cd(cd), correct_vac(vac)
+        memory[name] = tracemalloc.get_traced_memory()[1] / 1e6
+        tracemalloc.stop()
+    memory['tables'] = (df_cd.memory_usage(deep=True).sum() + df_vac.memory_usage(deep=True).sum()) / 1e6
+    return memory
+
+
+# seconds of the weekly reporting fix over the cases and deaths of every country, called per country
+# block and in one call over both columns laid end to end (numba kernel when installed, NumPy otherwise).
+def time_weekly_kernel(tb_country_cases_deaths, repeat = 3):
+    df_cd = td.basic_processing(tb_country_cases_deaths, td.features_cd)
+    countries, starts, stops = td.country_blocks(df_cd)
+    values = np.concatenate([df_cd[col].to_numpy(dtype='float64') for col in ['new_cases', 'new_deaths']])
+    all_starts = np.concatenate([starts, starts + len(df_cd)])
+    all_stops = np.concatenate([stops, stops + len(df_cd)])
+    td._weekly_reporting_blocks(values.copy(), all_starts, all_stops)  # compile the numba kernel first
+
+    timings = {'per country': np.inf, 'all blocks': np.inf}
+    for _ in range(repeat):
+        x = values.copy()
+        start = time.perf_counter()
+        for block_start, block_stop in zip(all_starts, all_stops):
+            td._weekly_reporting_kernel(x[block_start:block_stop])
+        timings['per country'] = min(timings['per country'], time.perf_counter() - start)
+
+        y = values.copy()
+        start = time.perf_counter()
+        td._weekly_reporting_blocks(y, all_starts, all_stops)
+        timings['all blocks'] = min(timings['all blocks'], time.perf_counter() - start)
+        assert np.array_equal(x, y, equal_nan=True), "weekly kernel differs between per-country and all-block calls"
+    return timings
+
+
+# rows of the tables dated on the given day(s).
+def rows_on(tb, dates):
+    return tb[tb.index.get_level_values('date').isin(pd.DatetimeIndex(dates))]
+
+
+# mean time (s) of a daily incremental update, starting from the tables without their last n_update_days,
+# and best time of a full recompute, checking that an update is faster (time it on tables the size of
+# OWID's, ~200 countries x 1700 days: on small tables both are cheap).
+def time_incremental_update(tb_country_cases_deaths, tb_country_vac, n_update_days = 30, repeat = 3):
+    dates = tb_country_cases_deaths.index.get_level_values('date').unique().sort_values()
+    initial_dates, update_dates = dates[:-n_update_days], dates[-n_update_days:]
+    state = td.IncrementalCovidData(rows_on(tb_country_cases_deaths, initial_dates), rows_on(tb_country_vac, initial_dates))
+    updates = [(rows_on(tb_country_cases_deaths, [date]), rows_on(tb_country_vac, [date])) for date in update_dates]
+
+    start = time.perf_counter()
+    for new_cd, new_vac in updates:
+        state.update(new_cd, new_vac)
+    update_time = (time.perf_counter() - start) / n_update_days
+
+    full_time = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        td.process_covid_data(tb_country_cases_deaths, tb_country_vac)
+        full_time = min(full_time, time.perf_counter() - start)
+    assert update_time < full_time, f"an incremental update ({update_time:.3f} s) is no faster than a full recompute ({full_time:.3f} s)"
+    return {'update': update_time, 'full': full_time}
+
+
+# peak memory (MB, from tracemalloc) of going through the corrected countries of the tables written as CSV
+# exports, read chunksize rows at a time, next to that of reading the whole CSVs and processing them.
+def measure_streaming_memory(tb_country_cases_deaths, tb_country_vac, chunksize = 5000):
+    import tempfile
+    import tracemalloc
+
+    with tempfile.TemporaryDirectory() as directory:
+        paths = [os.path.join(directory, 'cases_deaths.csv'), os.path.join(directory, 'vac.csv')]
+        for tb, path in zip([tb_country_cases_deaths, tb_country_vac], paths):
+            tb.reset_index().to_csv(path, index=False, float_format='%.17g')
+
+        memory = {}
+        tracemalloc.start()
+        for path, kind in zip(paths, ['cd', 'vac']):
+            for df in td.stream_covid_data(path, kind, chunksize):
+                pass
+        memory['streaming'] = tracemalloc.get_traced_memory()[1] / 1e6
+        tracemalloc.stop()
+
+        tracemalloc.start()
+        tables = [pd.read_csv(path, parse_dates=['date'], float_precision='round_trip').set_index(['country', 'date'])
+                  for path in paths]
+        td.process_covid_data(*tables)
+        memory['full tables'] = tracemalloc.get_traced_memory()[1] / 1e6
+        tracemalloc.stop()
+    return memory
+
+
+# frames per second of the world map animation (GIF included), redrawing everything per frame and with
+# WorldMapRenderer (serially, and in parallel with workers > 1), and of the renderer's frames alone.
+# start_date: first frame, the middle of the tables' dates if not given.
+def time_world_map_animation(tb_country_cases_deaths, world, n_days = 5, start_date = None, workers = 1):
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    import tempfile
+    import plot_data as pl
+
+    df_cd = td.correct_cases_deaths_by_country(td.basic_processing(tb_country_cases_deaths, td.features_cd))
+    panel = td.build_panel(df_cd)
+    if start_date is None:
+        start_date = panel.dates[len(panel.dates) // 2]
+    end_date = pd.Timestamp(start_date) + pd.Timedelta(days=n_days - 1)
+
+    fps = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for fast in [False, True]:
+            fig, ax = plt.subplots(figsize=(12, 8))
+            start = time.perf_counter()
+            pl.create_world_map_cases_animation(fig, ax, df_cd, world, f'{directory}/animation.gif', start_date, end_date,
+                                                40e3, panel=panel, fast=fast)
+            fps['renderer' if fast else 'redraw'] = n_days / (time.perf_counter() - start)
+            plt.close(fig)
+
+        # parallel rendering must give the same file as the serial renderer.
+        if workers > 1:
+            fig, ax = plt.subplots(figsize=(12, 8))
+            start = time.perf_counter()
+            pl.create_world_map_cases_animation(fig, ax, df_cd, world, f'{directory}/parallel.gif', start_date, end_date,
+                                                40e3, panel=panel, workers=workers)
+            fps[f'renderer, {workers} workers'] = n_days / (time.perf_counter() - start)
+            plt.close(fig)
+            with open(f'{directory}/animation.gif', 'rb') as serial, open(f'{directory}/parallel.gif', 'rb') as parallel:
+                assert serial.read() == parallel.read(), "parallel animation differs from the serial one"
+
+    # frames alone, without encoding the GIF.
+    renderer = pl.WorldMapRenderer(world, panel, 40e3)
+    start = time.perf_counter()
+    for date in pd.date_range(start_date, end_date):
+        renderer.render(date)
+    fps['renderer frames only'] = n_days / (time.perf_counter() - start)
+    return fps
+
+
+# seconds to write the cases/deaths and vaccination charts of n_countries countries: one plot_country_cd /
+# plot_country_vac call (and figure) per chart, and save_country_charts (serially, and in parallel with
+# workers > 1). Charts are drawn off screen and written to a temporary directory.
+def time_country_charts(tb_country_cases_deaths, tb_country_vac, n_countries = 20, workers = 1):
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    import tempfile
+    import plot_data as pl
+
+    df_cd, df_vac = td.process_covid_data(tb_country_cases_deaths, tb_country_vac)
+    panel = td.build_panel(df_cd, df_vac)
+    countries = list(panel.countries[:n_countries])
+    timings = {}
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        try:
+            start = time.perf_counter()
+            for country in countries:
+                pl.plot_country_cd(country, df_cd, panel=panel)
+                pl.plot_country_vac(country, df_vac, panel=panel)
+                plt.close('all')
+            timings['per call'] = time.perf_counter() - start
+        finally:
+            os.chdir(cwd)
+
+        runs = [('batch', 1)] + ([('batch parallel', workers)] if workers > 1 else [])
+        for name, n_workers in runs:
+            start = time.perf_counter()
+            pl.save_country_charts(df_cd, 'cd', countries, directory, panel=panel, workers=n_workers)
+            pl.save_country_charts(df_vac, 'vac', countries, directory, panel=panel, workers=n_workers)
+            timings[name] = time.perf_counter() - start
+    return timings
+
+
+# seconds to get the country geometry index by parsing the shapefile, and from the .npz stored next to it.
+def time_geometry_index(shapefile = 'ne_110m_admin_0_countries/ne_110m_admin_0_countries.shp', repeat = 3):
+    import geopandas as gpd
+    import plot_data as pl
+
+    timings = {'parse shapefile': np.inf, 'load index': np.inf}
+    pl.load_geometry_index(shapefile)
+    for _ in range(repeat):
+        start = time.perf_counter()
+        pl.build_geometry_index(gpd.read_file(shapefile))
+        timings['parse shapefile'] = min(timings['parse shapefile'], time.perf_counter() - start)
+        start = time.perf_counter()
+        pl.load_geometry_index(shapefile)
+        timings['load index'] = min(timings['load index'], time.perf_counter() - start)
+    return timings
+
+
+# Local catalog snapshots
+#--------------------------------
+
+# check the tables stored in a LocalCatalog load back exactly, and return the best time (s) to load both
+# tables from Arrow IPC (memory-mapped) and Parquet snapshots, Arrow IPC for the features of the pipeline
+# only, and from CSV exports.
+def time_snapshot_loads(tb_country_cases_deaths, tb_country_vac, repeat = 3):
+    import tempfile
+    import local_catalog as lc
+
+    tables = {'cases_deaths': tb_country_cases_deaths, 'vaccinations_global': tb_country_vac}
+    features = {'cases_deaths': td.features_cd, 'vaccinations_global': td.features_vac}
+    with tempfile.TemporaryDirectory() as directory:
+        catalogs = {}
+        for format in ['feather', 'parquet']:
+            catalogs[format] = lc.LocalCatalog(os.path.join(directory, format))
+            for table, tb in tables.items():
+                catalogs[format].add(tb, table, 'covid', format=format)
+                pd.testing.assert_frame_equal(catalogs[format].find_one(table=table, namespace='covid'), tb, check_exact=True)
+        for table, tb in tables.items():
+            tb.reset_index().to_csv(os.path.join(directory, f'{table}.csv'), index=False, float_format='%.17g')
+
+        loads = {
+            'feather': lambda: [catalogs['feather'].find_one(table=table) for table in tables],
+            'parquet': lambda: [catalogs['parquet'].find_one(table=table) for table in tables],
+            'feather, pipeline features': lambda: [catalogs['feather'].find_one(table=table, columns=features[table]) for table in tables],
+            'csv': lambda: [pd.read_csv(os.path.join(directory, f'{table}.csv'), parse_dates=['date'],
+                                        float_precision='round_trip').set_index(['country', 'date']) for table in tables],
+        }
+        timings = {}
+        for name, load in loads.items():
+            best = np.inf
+            for _ in range(repeat):
+                start = time.perf_counter()
+                load()
+                best = min(best, time.perf_counter() - start)
+            timings[name] = best
+    return timings
+
+
+# Import cost
+#--------------------------------
+# The modules import their plotting and geo dependencies on first use, so a compute-only worker doesn't load them.
+
+heavy_modules = ['matplotlib', 'geopandas', 'shapely', 'PIL', 'tqdm', 'networkx', 'seaborn', 'numba']
+
+
+# seconds to import each module in a fresh interpreter, on top of numpy and pandas (imported first, as every
+# module needs them), best of repeat runs, and the heavy modules each import loaded.
+def time_imports(modules = ('transform_data', 'statistical_analysis', 'data_cache', 'local_catalog', 'plot_data', 'covid19'),
+                 repeat = 3):
+    import json
+    import subprocess
+    import sys
+
+    timings, loaded = {}, {}
+    for module in modules:
+        code = (f"import json, sys, time\nimport numpy, pandas\nstart = time.perf_counter()\nimport {module}\n"
+                f"elapsed = time.perf_counter() - start\n"
+                f"print(json.dumps([elapsed, [m for m in {heavy_modules!r} if m in sys.modules]]))")
+        runs = [json.loads(subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True,
+                                          cwd=os.path.dirname(os.path.abspath(__file__))).stdout) for _ in range(repeat)]
+        timings[module] = min(elapsed for elapsed, heavy in runs)
+        loaded[module] = runs[0][1]
+    return timings, loaded
+
+
+# check importing the modules loads none of the heavy modules and takes less than budget seconds each (on top
+# of numpy and pandas), and return the import times.
+def check_import_cost(modules = ('transform_data', 'statistical_analysis', 'data_cache', 'local_catalog', 'plot_data', 'covid19'),
+                      budget = 0.2, repeat = 3):
+    timings, loaded = time_imports(modules, repeat)
+    for module in modules:
+        assert not loaded[module], f"importing {module} loads {', '.join(loaded[module])}"
+        assert timings[module] < budget, f"importing {module} takes {timings[module]:.3f} s (budget {budget} s)"
+    return timings
+
+
+# Notebook pipeline
+#--------------------------------
+
+# best time (s) of each step of main.ipynb on the given tables: processing, the panel, the cases/deaths
+# correlations (as in the notebook, their bootstrap with n_boot replicates, in a 90-day sliding window and over
+# an 11 x 11 grid of vaccination thresholds), the deaths vs vaccination date analysis for every country (with
+# its plot, and its metrics alone), and (when world is given) an animation_days long world map animation.
+# Figures are drawn off screen and written to a temporary directory.
+def time_pipeline(tb_country_cases_deaths, tb_country_vac, world = None, repeat = 3, animation_days = 5,
+                  max_lag = 200, v_low = 0.1, v_high = 0.9, n_boot = 200):
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    import tempfile
+    import statistical_analysis as sa
+
+    df_cd, df_vac = td.process_covid_data(tb_country_cases_deaths, tb_country_vac)
+    panel = td.build_panel(df_cd, df_vac)
+    country_list = list(panel.countries)
+    start_date = panel.dates[len(panel.dates) // 2]
+    end_date = start_date + pd.Timedelta(days=animation_days - 1)
+
+    steps = {
+        'process_covid_data': lambda: td.process_covid_data(tb_country_cases_deaths, tb_country_vac),
+        'build_panel': lambda: td.build_panel(df_cd, df_vac),
+        'find_cd_correlations_for_vax_rate': lambda: sa.find_cd_correlations_for_vax_rate(
+            df_cd, df_vac, v_low, v_high, max_lag, country_list, panel=panel),
+        'bootstrap_cd_correlations_for_vax_rate': lambda: sa.bootstrap_cd_correlations_for_vax_rate(
+            df_cd, df_vac, v_low, v_high, max_lag, country_list, n_boot=n_boot, workers=os.cpu_count(), panel=panel),
+        'rolling_cd_lagged_correlations': lambda: sa.rolling_cd_lagged_correlations(panel, max_lag, 90, country_list),
+        'sweep_cd_correlations_for_vax_rate': lambda: sa.sweep_cd_correlations_for_vax_rate(
+            df_cd, df_vac, np.linspace(0, 0.5, 11), np.linspace(0.5, 1, 11), max_lag, country_list, panel=panel),
+        'vax_vs_total_deaths': lambda: sa.vax_vs_total_deaths(df_cd, df_vac, country_list, panel=panel),
+        'vax_threshold_metrics': lambda: sa.vax_threshold_metrics(df_cd, df_vac, country_list),
+    }
+    if world is not None:
+        import plot_data as pl
+        geometry_index = pl.load_geometry_index()
+
+        def animation():
+            fig, ax = plt.subplots(figsize=(12, 8))
+            pl.create_world_map_cases_animation(fig, ax, df_cd, world, 'cases_animation.gif', start_date, end_date,
+                                                40e3, panel=panel, geometry_index=geometry_index)
+        steps['create_world_map_cases_animation'] = animation
+
+    timings = {}
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        try:
+            for name, step in steps.items():
+                best = np.inf
+                for _ in range(repeat):
+                    start = time.perf_counter()
+                    step()
+                    best = min(best, time.perf_counter() - start)
+                    plt.close('all')
+                timings[name] = best
+        finally:
+            os.chdir(cwd)
+    return timings
+
+
+def environment():
+    import platform
+    return {'python': platform.python_version(), 'platform': platform.platform(), 'cpus': os.cpu_count(),
+            'numpy': np.__version__, 'pandas': pd.__version__, 'numba': td._numba().__version__ if td._numba() is not None else None}
+
+
+if __name__ == '__main__':
+    import argparse
+    import json
+    from datetime import datetime
+
+    parser = argparse.ArgumentParser(description="Check and time the pipeline on synthetic OWID-shaped tables.")
+    parser.add_argument('--countries', type=int, default=50, help="number of countries")
+    parser.add_argument('--days', type=int, default=1000, help="number of days")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=3, help="runs per timing (the best is kept)")
+    parser.add_argument('--animation-days', type=int, default=5, help="frames of the world map animation")
+    parser.add_argument('--output', default='benchmark.json', help="JSON file the results are written to")
+    args = parser.parse_args()
+
+    try:
+        import geopandas as gpd
+    except ImportError:
+        gpd = None
+    world = gpd.read_file('ne_110m_admin_0_countries/ne_110m_admin_0_countries.shp') if gpd is not None else None
+    country_names = sorted(world['ADMIN']) if world is not None else None
+
+    tb_country_cases_deaths, tb_country_vac = make_synthetic_tables(args.countries, args.days, args.seed, country_names)
+    results = {'date': datetime.now().isoformat(timespec='seconds'), 'config': vars(args), 'environment': environment()}
+
+    results['imports'] = check_import_cost(repeat=args.repeat)
+    print('import time above numpy + pandas (s): ' + ', '.join(f'{name} {value:.3f}' for name, value in results['imports'].items()))
+
+    results['pipeline'] = time_pipeline(tb_country_cases_deaths, tb_country_vac, world, args.repeat, args.animation_days)
+    print('pipeline (s): ' + ', '.join(f'{name} {value:.3f}' for name, value in results['pipeline'].items()))
+
+    timings = time_cleaning(tb_country_cases_deaths, tb_country_vac, args.repeat)
+    results['cleaning'] = timings
+    print(f"process_covid_data: loop {timings['loop']:.3f} s, grouped {timings['grouped']:.3f} s "
+          f"({timings['loop'] / timings['grouped']:.1f}x)")
+    with td.StageProfiler(memory=True) as profiler:
+        td.process_covid_data(tb_country_cases_deaths, tb_country_vac)
+    stages = profiler.report()
+    results['stages'] = stages.to_dict(orient='records')
+    print('process_covid_data stages (times under tracemalloc):')
+    print(stages.round(4).to_string(index=False))
+    memory = measure_cleaning_memory(tb_country_cases_deaths, tb_country_vac)
+    results['corrections_memory_mb'] = memory
+    print(f"corrections peak memory: loop {memory['loop']:.1f} MB, grouped {memory['grouped']:.1f} MB "
+          f"(target: at most one copy of the tables, {memory['tables']:.1f} MB; grouped at "
+          f"{memory['grouped'] / memory['tables']:.0%} of it, {'met' if memory['grouped'] <= memory['tables'] else 'NOT met'})")
+    kernel_timings = time_weekly_kernel(tb_country_cases_deaths, args.repeat)
+    results['weekly_kernel'] = kernel_timings
+    print(f"weekly reporting kernel ({'numba' if td._numba() is not None else 'numpy'}): per country "
+          f"{kernel_timings['per country'] * 1e3:.2f} ms, all blocks {kernel_timings['all blocks'] * 1e3:.2f} ms")
+    df_cd, df_vac = td.process_covid_data(tb_country_cases_deaths, tb_country_vac)
+    compact_cd, compact_vac = td.compact_frames(df_cd, df_vac)
+    results['compact_memory_mb'] = {}
+    for name, df, compact in [('df_cd', df_cd, compact_cd), ('df_vac', df_vac, compact_vac)]:
+        report = td.memory_report(df, compact)
+        results['compact_memory_mb'][name] = {'before': report.loc['total', 'MB'], 'after': report.loc['total', 'compact MB']}
+        print(f'{name} memory, compact layout:')
+        print(report.round(3).to_string())
+    owid_cd, owid_vac = make_synthetic_tables(200, 1700, args.seed, country_names)
+    timings = time_incremental_update(owid_cd, owid_vac, repeat=args.repeat)
+    results['incremental_update'] = timings
+    print(f"incremental daily update (200 countries x 1700 days): {timings['update']:.3f} s, "
+          f"full recompute {timings['full']:.3f} s ({timings['full'] / timings['update']:.1f}x)")
+    memory = measure_streaming_memory(tb_country_cases_deaths, tb_country_vac)
+    results['streaming_memory_mb'] = memory
+    print(f"CSV ingestion peak memory: streaming {memory['streaming']:.1f} MB, full tables {memory['full tables']:.1f} MB")
+
+    timings = time_snapshot_loads(tb_country_cases_deaths, tb_country_vac, args.repeat)
+    results['snapshot_loads'] = timings
+    print('raw table loads (s): ' + ', '.join(f'{name} {value:.3f}' for name, value in timings.items()))
+
+    timings = time_country_charts(tb_country_cases_deaths, tb_country_vac, workers=os.cpu_count())
+    results['country_charts'] = timings
+    print('country charts (s): ' + ', '.join(f'{name} {value:.2f}' for name, value in timings.items()))
+
+    if world is not None:
+        timings = time_geometry_index(repeat=args.repeat)
+        results['geometry_index'] = timings
+        print(f"geometry index: parse shapefile {timings['parse shapefile']:.4f} s, load index {timings['load index']:.4f} s")
+        fps = time_world_map_animation(tb_country_cases_deaths, world, workers=os.cpu_count())
+        results['world_map_fps'] = fps
+        print('world map animation (frames/s): ' + ', '.join(f'{name} {value:.1f}' for name, value in fps.items()))
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=1, default=float)
+    print(f'results written to {args.output}')
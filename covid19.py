@@ -0,0 +1,267 @@
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import time
+import tracemalloc
+
+import pandas as pd
+
+import local_catalog as lc
+import transform_data as td
+
+
+# Batch pipeline
+#--------------------------------
+# python -m covid19 run --data-dir DIR runs the steps of main.ipynb without Jupyter, as a pipeline of stages:
+#  - ingest: the raw OWID tables read from DIR: a LocalCatalog of snapshots (found by table name), or else
+#    covid_cases_deaths and covid_vaccinations files (.parquet or .csv),
+#  - clean: process_covid_data on them,
+#  - analyses: the deaths vs vaccination metrics and the cases/deaths correlations of the low and high
+#    vaccination regimes, over the date range and countries asked for,
+#  - render: the charts of those countries, the figures of the analyses and (with --animation) the world map.
+# Each stage writes its outputs to the output directory and records the key they were made with: a hash of
+# its inputs (the keys of the stages it reads from, or the raw files' content), its parameters and the
+# source of the modules it runs. A stage whose outputs exist with the same key is skipped.
+# The time of every stage is printed and written to run_report.json, with its peak memory (tracemalloc) when
+# --trace-memory is given: tracing slows the stages down, so their times are then only indicative.
+
+table_names = {'cases_deaths': 'covid_cases_deaths', 'vac': 'covid_vaccinations'}
+catalog_namespace = 'covid'
+
+
+class Pipeline:
+
+    # force = True runs every stage, even when its outputs are up to date.
+    # trace_memory = True also records the peak memory of the stages (tracemalloc, which slows them down).
+    def __init__(self, output_dir, force = False, trace_memory = False):
+        self.output_dir = output_dir
+        self.force = force
+        self.trace_memory = trace_memory
+        os.makedirs(output_dir, exist_ok=True)
+        self.state_file = os.path.join(output_dir, 'stages.json')
+        self.state = {}
+        if os.path.exists(self.state_file):
+            with open(self.state_file) as f:
+                self.state = json.load(f)
+        self.report = []
+
+    def path(self, output):
+        return os.path.join(self.output_dir, output)
+
+    # run(*paths of outputs) unless the outputs were made with the same key; returns the key.
+    def stage(self, name, key_parts, outputs, run):
+        key = hashlib.sha256(json.dumps(key_parts, sort_keys=True, default=str).encode()).hexdigest()
+        paths = [self.path(output) for output in outputs]
+        if not self.force and self.state.get(name) == key and all(os.path.exists(path) for path in paths):
+            self.report.append({'stage': name, 'status': 'up to date', 'seconds': 0.0, 'peak_mb': None, 'memory_traced': False})
+            return key
+
+        peak_mb = None
+        if self.trace_memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        try:
+            run(*paths)
+            seconds = time.perf_counter() - start
+            if self.trace_memory:
+                peak_mb = tracemalloc.get_traced_memory()[1] / 1e6
+        finally:
+            if self.trace_memory:
+                tracemalloc.stop()
+        self.report.append({'stage': name, 'status': 'ran', 'seconds': seconds, 'peak_mb': peak_mb,
+                            'memory_traced': self.trace_memory})
+
+        # the key is recorded only once the outputs are written, so a failed stage runs again next time.
+        self.state[name] = key
+        tmp_file = self.state_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(self.state, f, indent=1)
+        os.replace(tmp_file, self.state_file)
+        return key
+
+
+# hash of the source of the given modules (the code version a stage's outputs were made with).
+def source_hash(*modules):
+    h = hashlib.sha256()
+    for module in modules:
+        with open(module.__file__, 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+
+# the file of a raw table in data_dir: name.parquet, or else name.csv.
+def raw_table_file(data_dir, name):
+    for extension in ['.parquet', '.csv']:
+        path = os.path.join(data_dir, name + extension)
+        if os.path.exists(path):
+            return path
+    raise FileNotFoundError(f"no {name}.parquet or {name}.csv in {data_dir}")
+
+
+# a raw table (indexed by country, date, as the catalog loads it) from a .parquet or .csv file.
+def read_raw_table(path):
+    if path.endswith('.parquet'):
+        tb = pd.read_parquet(path)
+    else:
+        tb = pd.read_csv(path, parse_dates=['date'], float_precision='round_trip')
+    if 'country' in tb.columns:
+        tb = tb.set_index(['country', 'date'])
+    return tb
+
+
+# the rows of df dated from start to end (either may be None).
+def in_date_range(df, start = None, end = None):
+    dates = pd.to_datetime(df['date'])
+    keep = pd.Series(True, index=df.index)
+    if start is not None:
+        keep &= dates >= pd.Timestamp(start)
+    if end is not None:
+        keep &= dates <= pd.Timestamp(end)
+    return df[keep]
+
+
+def run(args):
+    import statistical_analysis as sa
+    import plot_data as pl
+
+    pipeline = Pipeline(args.output_dir, args.force, args.trace_memory)
+
+    # Ingestion: the raw tables, stored as Parquet.
+    #--------------------------------
+    catalog = lc.LocalCatalog(args.data_dir)
+    if catalog.entries:
+        snapshots = {kind: catalog.find(table=lc.covid_tables[name], namespace=catalog_namespace)
+                     for kind, name in table_names.items()}
+        for kind, snapshot in snapshots.items():
+            if len(snapshot) != 1:
+                raise ValueError(f"{len(snapshot)} snapshots of '{lc.covid_tables[table_names[kind]]}' in {args.data_dir}")
+        sources = {kind: snapshot['sha256'].iloc[0] for kind, snapshot in snapshots.items()}
+        load = {kind: snapshot.load for kind, snapshot in snapshots.items()}
+    else:
+        raw_files = {kind: raw_table_file(args.data_dir, name) for kind, name in table_names.items()}
+        sources = {kind: lc.file_hash(path) for kind, path in raw_files.items()}
+        load = {kind: lambda path=path: read_raw_table(path) for kind, path in raw_files.items()}
+
+    def ingest(cd_path, vac_path):
+        for kind, path in [('cases_deaths', cd_path), ('vac', vac_path)]:
+            load[kind]().to_parquet(path)
+
+    ingest_key = pipeline.stage('ingest', sources, ['raw_cases_deaths.parquet', 'raw_vac.parquet'], ingest)
+
+    # Cleaning
+    #--------------------------------
+    def clean(cd_path, vac_path):
+        df_cd, df_vac = td.process_covid_data(pd.read_parquet(pipeline.path('raw_cases_deaths.parquet')),
+                                              pd.read_parquet(pipeline.path('raw_vac.parquet')))
+        df_cd.to_parquet(cd_path)
+        df_vac.to_parquet(vac_path)
+
+    clean_key = pipeline.stage('clean', [ingest_key, source_hash(td)], ['df_cd.parquet', 'df_vac.parquet'], clean)
+
+    # the cleaned frames over the date range, and their panel, read once for the stages that need them.
+    frames = {}
+
+    def load_frames():
+        if not frames:
+            df_cd = in_date_range(pd.read_parquet(pipeline.path('df_cd.parquet')), args.start, args.end)
+            df_vac = in_date_range(pd.read_parquet(pipeline.path('df_vac.parquet')), args.start, args.end)
+            panel = td.build_panel(df_cd, df_vac)
+            countries = args.countries if args.countries else list(panel.countries)
+            missing = [country for country in countries if country not in panel.country_index]
+            if missing:
+                raise ValueError(f"no data for {', '.join(missing)} between {args.start} and {args.end}")
+            frames.update(df_cd=df_cd, df_vac=df_vac, panel=panel, countries=countries)
+        return frames
+
+    # Analyses
+    #--------------------------------
+    def analyses(metrics_path, correlations_path):
+        f = load_frames()
+        metrics = sa.vax_threshold_metrics(f['df_cd'], f['df_vac'], f['countries'], args.vax_threshold, panel=f['panel'])
+        metrics.to_csv(metrics_path)
+        max_lagged_corr = sa.find_cd_correlations_for_vax_rate(f['df_cd'], f['df_vac'], args.v_low, args.v_high,
+                                                               args.max_lag, f['countries'], panel=f['panel'])
+        correlations = pd.DataFrame.from_dict(max_lagged_corr, orient='index',
+                                              columns=['lag_low', 'corr_low', 'lag_high', 'corr_high'])
+        correlations.index.name = 'country'
+        correlations.to_csv(correlations_path)
+
+    parameters = {name: getattr(args, name) for name in ['start', 'end', 'countries', 'v_low', 'v_high', 'max_lag', 'vax_threshold']}
+    analyses_key = pipeline.stage('analyses', [clean_key, parameters, source_hash(td, sa)],
+                                  ['vax_metrics.csv', 'correlations.csv'], analyses)
+
+    # Rendering
+    #--------------------------------
+    outputs = ['charts', 'cd_vax.png', 'correlation_data.png'] + (['cases_animation.gif'] if args.animation else [])
+
+    def render(charts_dir, cd_vax_path, correlation_path, animation_path = None):
+        f = load_frames()
+        shutil.rmtree(charts_dir, ignore_errors=True)  # no charts left from another country list
+        for kind, df in [('cd', f['df_cd']), ('vac', f['df_vac'])]:
+            pl.save_country_charts(df, kind, f['countries'], charts_dir, panel=f['panel'], workers=args.workers)
+
+        metrics = pd.read_csv(pipeline.path('vax_metrics.csv'), index_col='country', parse_dates=['vax_date'])
+        sa.save_vax_vs_total_deaths(metrics, cd_vax_path, label=f'{args.vax_threshold * 100:g}%')
+        correlations = pd.read_csv(pipeline.path('correlations.csv'), index_col='country')
+        max_lagged_corr = {country: list(row) for country, row in zip(correlations.index, correlations.to_numpy())}
+        sa.save_cd_correlation_vax_rate(max_lagged_corr, args.v_low, args.v_high, f['countries'], correlation_path)
+
+        if animation_path is not None:
+            import matplotlib
+            matplotlib.use('Agg')
+            import matplotlib.pyplot as plt
+            import geopandas as gpd
+
+            fig, ax = plt.subplots(figsize=(12, 8))
+            pl.create_world_map_cases_animation(fig, ax, f['df_cd'], gpd.read_file(args.shapefile), animation_path,
+                                                f['panel'].dates[0], f['panel'].dates[-1], args.num_show_name,
+                                                panel=f['panel'], workers=args.workers,
+                                                geometry_index=pl.load_geometry_index(args.shapefile))
+            plt.close(fig)
+
+    render_parameters = {name: getattr(args, name) for name in ['animation', 'num_show_name', 'shapefile']}
+    pipeline.stage('render', [analyses_key, render_parameters, source_hash(pl, sa)], outputs, render)
+
+    report = pd.DataFrame(pipeline.report)
+    shown = report if args.trace_memory else report.drop(columns=['peak_mb', 'memory_traced'])
+    print(shown.round({'seconds': 3, 'peak_mb': 1}).to_string(index=False))
+    with open(pipeline.path('run_report.json'), 'w') as f:
+        json.dump(pipeline.report, f, indent=1)
+    return report
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(prog='python -m covid19', description="COVID-19 cases, deaths and vaccination pipeline.")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser('run', help="run the pipeline, skipping the stages whose outputs are up to date")
+    run_parser.add_argument('--data-dir', required=True,
+                            help="directory of the raw tables: a local catalog of snapshots (see local_catalog), "
+                                 "or covid_cases_deaths and covid_vaccinations as .parquet or .csv")
+    run_parser.add_argument('--output-dir', default='output', help="directory of the stages' outputs")
+    run_parser.add_argument('--start', help="first date analysed (YYYY-MM-DD)")
+    run_parser.add_argument('--end', help="last date analysed (YYYY-MM-DD)")
+    run_parser.add_argument('--countries', type=lambda s: [c.strip() for c in s.split(',') if c.strip()],
+                            help="comma-separated countries (all of them by default)")
+    run_parser.add_argument('--v-low', type=float, default=0.1, help="vaccination rate of the low regime")
+    run_parser.add_argument('--v-high', type=float, default=0.9, help="vaccination rate of the high regime")
+    run_parser.add_argument('--max-lag', type=int, default=200, help="largest cases/deaths lag (days)")
+    run_parser.add_argument('--vax-threshold', type=float, default=0.8,
+                            help="vaccination rate of the deaths vs vaccination date analysis")
+    run_parser.add_argument('--animation', action='store_true', help="also render the world map animation of the date range")
+    run_parser.add_argument('--shapefile', default='ne_110m_admin_0_countries/ne_110m_admin_0_countries.shp')
+    run_parser.add_argument('--num-show-name', type=float, default=40e3, help="cases above which the map shows a country's name")
+    run_parser.add_argument('--workers', type=int, default=1, help="processes rendering the charts and the animation")
+    run_parser.add_argument('--force', action='store_true', help="run every stage, even when its outputs are up to date")
+    run_parser.add_argument('--trace-memory', action='store_true',
+                            help="also record the peak memory of each stage (tracemalloc, which slows the stages down)")
+    args = parser.parse_args(argv)
+
+    if args.command == 'run':
+        run(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,150 @@
+import hashlib
+import json
+import os
+import time
+
+import pandas as pd
+
+import transform_data as td
+
+
+# On-disk cache of the raw OWID tables and the processed df_cd / df_vac.
+#--------------------------------
+# Every entry is one Parquet file in the cache directory. index.json records, for each file, the
+# entry's name and key, the content hash of the table stored in it, its size and when it was last used.
+# Everything is local, so the cache works offline once it holds the raw tables.
+#  - raw tables are keyed by name (e.g. 'covid_cases_deaths') and version (e.g. the sha256 of the snapshot
+#    they were loaded from), so once stored they load without the network, and a new snapshot replaces them,
+#  - processed tables are keyed by the versions of the raw tables (or, without them, a hash of the columns
+#    process_covid_data reads) and the version of transform_data, so they are recomputed whenever the input
+#    or the transform code changes.
+# When the files take more than max_bytes, the least recently used processed tables are deleted (raw tables
+# are never evicted: only the network could bring them back).
+class DataCache:
+
+    def __init__(self, directory, max_bytes = 2e9):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        self.index_file = os.path.join(directory, 'index.json')
+        self.index = {}
+        if os.path.exists(self.index_file):
+            with open(self.index_file) as f:
+                self.index = json.load(f)
+
+        # forget entries whose file was removed by hand.
+        self.index = {file: entry for file, entry in self.index.items() if os.path.exists(self._path(file))}
+
+    def _path(self, file):
+        return os.path.join(self.directory, file)
+
+    def _file(self, name, key):
+        return f'{name}-{key[:16]}.parquet'
+
+    def _save_index(self):
+        tmp_file = self.index_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(self.index, f, indent=1)
+        os.replace(tmp_file, self.index_file)
+
+    def __contains__(self, name_key):
+        return self._file(*name_key) in self.index
+
+    def get(self, name, key):
+        file = self._file(name, key)
+        if file not in self.index:
+            return None
+        df = pd.read_parquet(self._path(file))
+        self.index[file]['last_used'] = time.time()
+        self._save_index()
+        return df
+
+    # raw = True stores a raw table, which _evict keeps.
+    def put(self, name, key, df, raw = False):
+        file = self._file(name, key)
+        tmp_path = self._path(file + '.tmp')
+        pd.DataFrame(df).to_parquet(tmp_path)
+        os.replace(tmp_path, self._path(file))
+        self.index[file] = {'name': name, 'key': key, 'hash': table_hash(df),
+                            'size': os.path.getsize(self._path(file)), 'last_used': time.time(), 'raw': raw}
+        self._evict(keep=file)
+        self._save_index()
+
+    def _remove(self, file):
+        os.remove(self._path(file))
+        del self.index[file]
+
+    # delete the least recently used processed tables until the cache fits in max_bytes (the new file and
+    # the raw tables are always kept).
+    def _evict(self, keep):
+        total = sum(entry['size'] for entry in self.index.values())
+        for file in sorted(self.index, key=lambda f: self.index[f]['last_used']):
+            if total <= self.max_bytes:
+                break
+            if file == keep or _is_raw(self.index[file]):
+                continue
+            total -= self.index[file]['size']
+            self._remove(file)
+
+    # a raw table by name and version (e.g. the sha256 of its snapshot, from LocalCatalog.find): read from the
+    # cache, or loaded with loader() (e.g. from the OWID catalog) and stored in place of its other versions.
+    def load_table(self, name, loader = None, version = 'raw'):
+        df = self.get(name, version)
+        if df is None:
+            if loader is None:
+                raise KeyError(f"table '{name}' (version {version}) is not in the cache at {self.directory}")
+            df = loader()
+            for file, entry in list(self.index.items()):
+                if entry['name'] == name and _is_raw(entry):
+                    self._remove(file)
+            self.put(name, version, df, raw=True)
+        return df
+
+
+# whether an index entry holds a raw table (entries written before the 'raw' field have the key 'raw').
+def _is_raw(entry):
+    return entry.get('raw', entry['key'] == 'raw')
+
+
+# content hash of a table: its values, index, column names and dtypes.
+def table_hash(df):
+    h = hashlib.sha256()
+    h.update(pd.util.hash_pandas_object(df, index=True).to_numpy().tobytes())
+    h.update(repr(list(df.columns)).encode())
+    h.update(repr([str(dtype) for dtype in df.dtypes]).encode())
+    return h.hexdigest()
+
+
+# version of the transform code: a hash of transform_data's source.
+def transform_version():
+    with open(td.__file__, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+# hash of what process_covid_data reads from a raw table: its index and the feature columns.
+def input_hash(df, features):
+    h = hashlib.sha256()
+    h.update(pd.util.hash_pandas_object(df.index).to_numpy().tobytes())
+    for col in features:
+        h.update(col.encode())
+        h.update(pd.util.hash_pandas_object(df[col], index=False).to_numpy().tobytes())
+    return h.hexdigest()
+
+
+# process_covid_data, reading df_cd and df_vac from the cache when it already holds them for these tables
+# and this version of transform_data.
+# versions: the versions the raw tables were loaded with (e.g. their snapshots' sha256, as given to
+# load_table), so a cache hit costs no pass over the tables; without them the index and the feature
+# columns are hashed, which takes a fair share of the time processing them would.
+def cached_process_covid_data(cache, tb_country_cases_deaths, tb_country_vac, versions = None):
+    if versions is None:
+        versions = [input_hash(tb_country_cases_deaths, td.features_cd), input_hash(tb_country_vac, td.features_vac)]
+    key = hashlib.sha256('/'.join(list(versions) + [transform_version()]).encode()).hexdigest()
+
+    df_cd = cache.get('df_cd', key)
+    df_vac = cache.get('df_vac', key)
+    if df_cd is None or df_vac is None:
+        df_cd, df_vac = td.process_covid_data(tb_country_cases_deaths, tb_country_vac)
+        cache.put('df_cd', key, df_cd)
+        cache.put('df_vac', key, df_vac)
+    return df_cd, df_vac
@@ -0,0 +1,136 @@
+import hashlib
+import json
+import os
+
+import pandas as pd
+
+
+# Local stand-in for the OWID catalog
+#--------------------------------
+# A directory of table snapshots with the find / load surface of owid.catalog, so the pipeline runs offline
+# (in CI, on batch nodes without network) on exactly the same tables every time. catalog.json lists the
+# snapshots: table, namespace, dataset, version, file, format, index columns and the file's sha256.
+# Tables are found by name (not by their row in the catalog), and stored as uncompressed Arrow IPC
+# ('feather', read memory-mapped) or Parquet ('parquet', columnar), so load(columns=...) only reads the
+# columns asked for.
+class LocalCatalog:
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.manifest_file = os.path.join(directory, 'catalog.json')
+        self.entries = []
+        if os.path.exists(self.manifest_file):
+            with open(self.manifest_file) as f:
+                self.entries = json.load(f)
+
+    # the snapshots matching every given field, as a CatalogFrame whose rows load their table
+    # (catalog.find(table=..., namespace=...).iloc[0].load(), as with owid.catalog).
+    def find(self, table = None, namespace = None, dataset = None, version = None):
+        query = {'table': table, 'namespace': namespace, 'dataset': dataset, 'version': version}
+        rows = [entry for entry in self.entries if all(value is None or entry[field] == value for field, value in query.items())]
+        frame = CatalogFrame(rows, columns=['table', 'namespace', 'dataset', 'version', 'file', 'format', 'index', 'sha256'])
+        frame['path'] = [os.path.join(self.directory, file) for file in frame['file']]
+        return frame
+
+    # the table of the one snapshot matching the fields (ValueError when there are none or several).
+    def find_one(self, table = None, namespace = None, dataset = None, version = None, columns = None):
+        return self.find(table, namespace, dataset, version).load(columns)
+
+    # store tb as the snapshot of table (replacing any snapshot of the same table, namespace and version).
+    def add(self, tb, table, namespace, dataset = None, version = 'latest', format = 'feather'):
+        os.makedirs(os.path.join(self.directory, namespace), exist_ok=True)
+        file = os.path.join(namespace, f'{table}.{version}.{format}')
+        path = os.path.join(self.directory, file)
+        index = [name for name in tb.index.names if name is not None]
+        df = pd.DataFrame(tb).reset_index() if index else pd.DataFrame(tb)
+
+        tmp_path = path + '.tmp'
+        if format == 'feather':
+            df.to_feather(tmp_path, compression='uncompressed')
+        elif format == 'parquet':
+            df.to_parquet(tmp_path, index=False)
+        else:
+            raise ValueError(f"unsupported snapshot format '{format}' (use 'feather' or 'parquet')")
+        os.replace(tmp_path, path)
+
+        entry = {'table': table, 'namespace': namespace, 'dataset': dataset if dataset is not None else table,
+                 'version': version, 'file': file, 'format': format, 'index': index, 'sha256': file_hash(path)}
+        self.entries = [e for e in self.entries if (e['table'], e['namespace'], e['version']) != (table, namespace, version)]
+        self.entries.append(entry)
+        tmp_file = self.manifest_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(self.entries, f, indent=1)
+        os.replace(tmp_file, self.manifest_file)
+        return entry
+
+
+# catalog rows, as a DataFrame whose rows (CatalogSeries) load their table.
+class CatalogFrame(pd.DataFrame):
+
+    @property
+    def _constructor(self):
+        return CatalogFrame
+
+    @property
+    def _constructor_sliced(self):
+        return CatalogSeries
+
+    # the table of the only row.
+    def load(self, columns = None):
+        if len(self) != 1:
+            raise ValueError(f"{len(self)} tables match, load one row (e.g. .iloc[0].load())")
+        return self.iloc[0].load(columns)
+
+
+class CatalogSeries(pd.Series):
+
+    @property
+    def _constructor(self):
+        return CatalogSeries
+
+    @property
+    def _constructor_expanddim(self):
+        return CatalogFrame
+
+    # the row's table, indexed as it was stored. columns: the columns to read (all of them by default).
+    def load(self, columns = None):
+        return read_snapshot(self['path'], self['format'], list(self['index']), columns)
+
+
+def read_snapshot(path, format, index, columns = None):
+    if columns is not None:
+        columns = index + [col for col in columns if col not in index]
+    if format == 'feather':
+        import pyarrow.feather as feather
+        df = feather.read_table(path, columns=columns, memory_map=True).to_pandas()
+    else:
+        df = pd.read_parquet(path, columns=columns)
+    return df.set_index(index) if index else df
+
+
+# content hash of a file, read in 1 MB blocks.
+def file_hash(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+# the covid tables of the pipeline, by name in the OWID catalog.
+covid_tables = {'covid_cases_deaths': 'cases_deaths', 'covid_vaccinations': 'vaccinations_global'}
+
+
+# snapshot the latest version of the given tables of the OWID catalog (needs the network and owid-catalog).
+def snapshot_owid_tables(directory, tables = tuple(covid_tables.values()), namespace = 'covid', format = 'feather'):
+    from owid import catalog
+
+    local = LocalCatalog(directory)
+    for table in tables:
+        found = catalog.find(table=table, namespace=namespace)
+        found = found[found['table'] == table].sort_values('version')
+        if len(found) == 0:
+            raise KeyError(f"table '{table}' not found in the OWID catalog namespace '{namespace}'")
+        row = found.iloc[-1]
+        local.add(row.load(), table, namespace, row['dataset'], str(row['version']), format)
+    return local
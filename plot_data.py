@@ -1,32 +1,41 @@
 # import libraries
-from pprint import pprint
-import importlib
-import matplotlib.pyplot as plt
 import pandas as pd
-from shapely.geometry import Point
-import matplotlib.animation as animation
-from datetime import timedelta
-import geopandas as gpd
-import matplotlib.animation as animation
-from PIL import Image
 import io
-from datetime import datetime
 import os
-from tqdm import tqdm
+import hashlib
+import shutil
+import subprocess
+import numpy as np
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+# matplotlib, geopandas, PIL and tqdm are imported by the functions that use them, so importing plot_data
+# doesn't load them.
+
+import transform_data as td
 
 # Plot a country's case and death data with dates
-def plot_country_cd(country, df):
-    # Ensure 'date' is in datetime format
-    df['date'] = pd.to_datetime(df['date'])
-    
-    # Filter the data for the selected country
-    country_data = df[df['country'] == country]
+# panel: optional td.CovidPanel, read instead of filtering df.
+# smooth_zero_days = True plots the cases as shown on the map (zero-case days replaced by the 7-day average).
+def plot_country_cd(country, df, panel = None, smooth_zero_days = False):
+    import matplotlib.pyplot as plt
+
+    cases = 'new_cases_display' if smooth_zero_days else 'new_cases'
+    if panel is not None:
+        country_data = pd.DataFrame({'date': panel.dates,
+                                     cases: panel.series(cases, country).to_numpy(),
+                                     'new_deaths': panel.series('new_deaths', country).to_numpy()})
+    else:
+        # Filter the data for the selected country, with 'date' in datetime format (df is left as it is)
+        country_data = df[df['country'] == country]
+        country_data = country_data.assign(date=pd.to_datetime(country_data['date']))
+        if smooth_zero_days:
+            country_data = country_data.assign(new_cases_display=td.new_cases_display(country_data['new_cases'], country_data['date']))
 
     # Create figure and axis
     fig, ax2 = plt.subplots(figsize=(10, 6))  # Optional: Adjust figure size for better readability
     
     # Plot the daily cases on the left-hand side axis
-    line1, = ax2.plot(country_data['date'], country_data['new_cases'], label="Daily new cases", color='b')  
+    line1, = ax2.plot(country_data['date'], country_data[cases], label="Daily new cases", color='b')  
     ax2.set_xlabel("Date")
     ax2.set_ylabel("Daily new cases")  # Label for the left-hand axis
     
@@ -49,12 +58,20 @@ def plot_country_cd(country, df):
 
 
 # Plot a country's vaccination data
-def plot_country_vac(country, df):
-    # Ensure 'date' is in datetime format
-    df['date'] = pd.to_datetime(df['date'])
-    
-    # Filter data for the given country
-    df_country = df[df['country'] == country]
+# panel: optional td.CovidPanel, read instead of filtering df.
+def plot_country_vac(country, df, panel = None):
+    import matplotlib.pyplot as plt
+
+    if panel is not None:
+        features = ["daily_people_vaccinated_smoothed_per_hundred", "people_fully_vaccinated_per_hundred", 
+                    "total_boosters_per_hundred"]
+        df_country = pd.DataFrame({'date': panel.dates})
+        for feature in features:
+            df_country[feature] = panel.series(feature, country).to_numpy()
+    else:
+        # Filter data for the given country, with 'date' in datetime format (df is left as it is)
+        df_country = df[df['country'] == country]
+        df_country = df_country.assign(date=pd.to_datetime(df_country['date']))
 
     # Create figure and axis
     fig, ax2 = plt.subplots(figsize=(10, 6))  # Adjust figure size for better readability
@@ -90,6 +107,115 @@ def plot_country_vac(country, df):
     plt.show()
 
 
+# Batch per-country charts
+#--------------------------------
+# The charts of plot_country_cd and plot_country_vac for many countries, written as PNGs without being shown.
+# One off-screen figure is laid out per chart kind ('cd' or 'vac'), and each country only sets the y data of
+# its lines (the x data, the panel's dates, is the same for every country) and rescales the axes.
+class CountryChartRenderer:
+
+    # smooth_zero_days = True plots the cases as shown on the map (as in plot_country_cd).
+    def __init__(self, kind, panel, dpi = 150, smooth_zero_days = False):
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+        self.kind = kind
+        self.panel = panel
+        self.dpi = dpi
+        self.fig = Figure(figsize=(10, 6))
+        self.canvas = FigureCanvasAgg(self.fig)
+        ax2 = self.fig.add_subplot()
+        ax1 = ax2.twinx()
+        self.axes = [ax2, ax1]
+        empty = np.full(len(panel.dates), np.nan)
+
+        if kind == 'cd':
+            cases = 'new_cases_display' if smooth_zero_days else 'new_cases'
+            line1, = ax2.plot(panel.dates, empty, label="Daily new cases", color='b')
+            ax2.set_xlabel("Date")
+            ax2.set_ylabel("Daily new cases")
+            line2, = ax1.plot(panel.dates, empty, label="Daily deaths", color='r')
+            ax1.set_ylabel("Daily deaths")
+            self.lines = [(line1, cases), (line2, 'new_deaths')]
+        else:
+            line1, = ax2.plot(panel.dates, empty, label="Daily Vaccinations per 100", color='r')
+            ax2.set_xlabel("Date")
+            ax2.set_ylabel("Daily Vaccinations per 100", color='r')
+            ax2.tick_params(axis='y', labelcolor='r')
+            ax2.tick_params(axis='x', labelrotation=45)
+            line2, = ax1.plot(panel.dates, empty, label="People Vaccinated (%)", color='b')
+            line3, = ax1.plot(panel.dates, empty, label="Boosters (%)", color='g')
+            ax1.set_ylabel("Percentage of Population (%)")
+            ax1.tick_params(axis='y', labelcolor='black')
+            self.lines = [(line1, 'daily_people_vaccinated_smoothed_per_hundred'),
+                          (line2, 'people_fully_vaccinated_per_hundred'), (line3, 'total_boosters_per_hundred')]
+
+        lines = [line for line, feature in self.lines]
+        ax2.legend(lines, [line.get_label() for line in lines], loc="upper left")
+        # the limits of the axes with no data, which autoscale_view leaves as they were.
+        self.empty_limits = [(ax.get_xlim(), ax.get_ylim()) for ax in self.axes]
+
+    # write one country's chart to directory, named as plot_country_cd / plot_country_vac name it; returns its path.
+    def render(self, country, directory = '.'):
+        j = self.panel.country_index[country]
+        for line, feature in self.lines:
+            line.set_ydata(self.panel.values[feature][:, j])
+        for ax in self.axes:
+            ax.relim()
+        empty = [not np.isfinite(ax.dataLim.x0) for ax in self.axes]
+        for ax, is_empty, (xlim, ylim) in zip(self.axes, empty, self.empty_limits):
+            if is_empty:
+                ax.set_ylim(ylim, auto=None)
+            if all(empty):
+                ax.set_xlim(xlim, auto=None)
+        for ax in self.axes:
+            ax.autoscale_view()
+        path = os.path.join(directory, chart_file(self.kind, country))
+        self.fig.savefig(path, dpi=self.dpi)
+        return path
+
+
+def chart_file(kind, country):
+    return f'{country}_cases_deaths_data.png' if kind == 'cd' else f'{country}_vaccination_data.png'
+
+
+# write the charts of the given countries (all of them by default) to directory and return their paths.
+# kind: 'cd' (plot_country_cd, from df_cd) or 'vac' (plot_country_vac, from df_vac).
+# panel: optional td.CovidPanel, built once from df if not given.
+# workers > 1 renders the countries in that many worker processes, each with its own figure.
+def save_country_charts(df, kind, countries = None, directory = '.', panel = None, workers = 1, dpi = 150,
+                        smooth_zero_days = False):
+    if panel is None:
+        panel = td.build_panel(df)
+    if countries is None:
+        countries = list(panel.countries)
+    os.makedirs(directory, exist_ok=True)
+
+    if workers <= 1:
+        renderer = CountryChartRenderer(kind, panel, dpi, smooth_zero_days)
+        return [renderer.render(country, directory) for country in countries]
+
+    chunk_size = max(1, int(np.ceil(len(countries) / (workers * 4))))
+    chunks = [(countries[i:i + chunk_size], directory) for i in range(0, len(countries), chunk_size)]
+    with ProcessPoolExecutor(workers, initializer=_init_chart_worker, initargs=(kind, panel, dpi, smooth_zero_days)) as executor:
+        return [path for paths in executor.map(_render_charts, chunks) for path in paths]
+
+
+_worker_chart_renderer = None
+
+
+def _init_chart_worker(kind, panel, dpi, smooth_zero_days):
+    global _worker_chart_renderer
+    import matplotlib
+    matplotlib.use('Agg')
+    _worker_chart_renderer = CountryChartRenderer(kind, panel, dpi, smooth_zero_days)
+
+
+def _render_charts(chunk):
+    countries, directory = chunk
+    return [_worker_chart_renderer.render(country, directory) for country in countries]
+
+
 
 
 
@@ -105,13 +231,20 @@ def disp_catalogue_info(cat):
         print(f"{index:<5} | {table:<30} | {dataset:<30} | {str(formats):<30}")
 
 # Function to plot covid cases as circles on the world map, for a specific date
-def plot_world_map_with_circles(fig, ax, df_cd, world, date, num_show_name, show_plot = False):
-    
-    # Filter data for the specific date
-    country_cases = df_cd[df_cd['date'] == date]
+# panel: optional td.CovidPanel, read instead of filtering df_cd for every country.
+# geometry_index: optional GeometryIndex of the shapefile, built from world if not given.
+def plot_world_map_with_circles(fig, ax, df_cd, world, date, num_show_name, show_plot = False, panel = None, geometry_index = None):
+    import matplotlib.pyplot as plt
+    if geometry_index is None:
+        geometry_index = build_geometry_index(world)
     
     # get the formatted country cases
-    all_countries = df_cd['country'].unique()
+    all_countries = panel.countries if panel is not None else df_cd['country'].unique()
+
+    # Last 7 days including today, for the countries with zero cases
+    prev_dates = pd.date_range(end=date, periods=7, freq='D')
+    if panel is not None:
+        cases_today = pd.Series(map_cases(panel, date), index=panel.countries)
     
     # Create a GeoDataFrame for plotting the world map
     world.plot(ax=ax, color='lightgray')
@@ -121,32 +254,35 @@ def plot_world_map_with_circles(fig, ax, df_cd, world, date, num_show_name, show
     
         try:     
             # Get the centroid of the country
-            cases = df_cd[(df_cd['date'] == date) & (df_cd['country'] == country)]['new_cases'].iloc[0]
+            if panel is not None:
+                cases = cases_today[country]
+                if pd.isna(cases):
+                    continue  # no data for this country on this date
+            else:
+                cases = df_cd[(df_cd['date'] == date) & (df_cd['country'] == country)]['new_cases'].iloc[0]
             
-            # If cases are zero, take the average of the last week.
-            if cases == 0:
-                prev_dates = pd.date_range(end=date, periods=7, freq='D')  # Last 7 days including today
+            # If cases are zero, take the average of the last week (already done in the panel's new_cases_display).
+            if panel is None and cases == 0:
                 prev_cases = df_cd[(df_cd['date'].isin(prev_dates)) & (df_cd['country'] == country)]['new_cases']
                 
                 # Calculate the average of the 7 days
                 cases = prev_cases.mean()  # Average over the 7 days, including today's zero case
             
-            if country == 'United States':
-                country_geom = world[world['ADMIN'] == 'United States of America'].geometry.iloc[0]
-            else:
-                country_geom = world[world['ADMIN'] == country].geometry.iloc[0]  
-            country_centroid = country_geom.centroid
+            row = geometry_index.lookup([country])[0]
+            if row < 0:
+                continue  # In case a country is missing from the shapefile
+            centroid_x, centroid_y = geometry_index.centroids[row]
     
             # Create a circle at the centroid location with size based on cases
-            ax.scatter(country_centroid.x, country_centroid.y, s=cases / 250, color='red', alpha=0.5)
+            ax.scatter(centroid_x, centroid_y, s=cases / 250, color='red', alpha=0.5)
     
             # Add the country's name above the circle if cases exceed num_show_name
             if cases > num_show_name:
                 circle_radius = cases / 250
-                ax.text(country_centroid.x, country_centroid.y + (circle_radius / 100), country, fontsize=8, ha='center', color='black')
+                ax.text(centroid_x, centroid_y + (circle_radius / 100), country, fontsize=8, ha='center', color='black')
     
         except IndexError:
-            continue  # In case a country is missing from the shapefile
+            continue  # In case the country has no data on this date
     
     # Add title and show the plot
     date = pd.to_datetime(date)
@@ -159,36 +295,411 @@ def plot_world_map_with_circles(fig, ax, df_cd, world, date, num_show_name, show
 
 
 # Create gif of cases by country on the world map each day without saving PNGs
-def create_world_map_cases_animation(fig, ax, df_cd, world, output_file,start_date, end_date, num_show_name):
+# panel: optional td.CovidPanel of df_cd, built once here if not given.
+# fast = True draws the frames with WorldMapRenderer (basemap drawn once, only the circles, labels and
+# title redrawn per frame), fast = False redraws everything with plot_world_map_with_circles.
+# workers > 1 draws the frames (fast only) in that many worker processes, which also encode them for a GIF;
+# the output is the same file.
+# geometry_index: optional GeometryIndex of the shapefile (e.g. from load_geometry_index), built from world if not given.
+def create_world_map_cases_animation(fig, ax, df_cd, world, output_file,start_date, end_date, num_show_name, panel = None, fast = True, workers = 1,
+                                     geometry_index = None):
+    import matplotlib.pyplot as plt
+    from PIL import Image
+    from tqdm import tqdm
+
+    if panel is None:
+        panel = td.build_panel(df_cd)
 
     # dates to make gif through
     dates = pd.date_range(start=start_date, end=end_date)
 
-    # Prepare a list to store frames
-    frames = []
-
-    # Generate frames for each date
-    for date in tqdm(dates, desc="Processing dates", unit="date"):
-        ax.clear()  # Clear the axis for each frame
-        plot_world_map_with_circles(fig, ax, df_cd, world, date, num_show_name)
-    
-        # Save the current frame to a BytesIO buffer
-        buf = io.BytesIO()
-        plt.savefig(buf, format='png', bbox_inches='tight', pad_inches=0)
-        buf.seek(0)
-        
-        # Open the frame as an image and append it to the frames list
-        frame = Image.open(buf)
-        frames.append(frame)
-
-    # Create the GIF directly from the frames
-    frames[0].save(output_file, save_all=True, append_images=frames[1:], duration=500, loop=0)
+    if geometry_index is None:
+        geometry_index = build_geometry_index(world)
+
+    # Each frame is encoded as soon as it is drawn (GIF, or MP4/WebM through ffmpeg, from the file extension)
+    with open_animation_writer(output_file, duration=500) as writer:
+        if fast and workers > 1 and isinstance(writer, GifWriter) and len(dates) > 1:
+            # the first frame, drawn here, sets the GIF's palette; the workers draw and encode the others with it.
+            renderer = WorldMapRenderer(world, panel, num_show_name, figsize=fig.get_size_inches(), dpi=fig.dpi,
+                                        geometry_index=geometry_index)
+            writer.write(renderer.render(dates[0]))
+            del renderer
+            frames = render_world_map_frames_parallel(world, panel, num_show_name, dates[1:], workers,
+                                                      figsize=fig.get_size_inches(), dpi=fig.dpi,
+                                                      geometry_index=geometry_index, gif_encoder=writer.encoder)
+            for data in tqdm(frames, total=len(dates), initial=1, desc="Processing dates", unit="date"):
+                writer.write_encoded(data)
+        elif fast:
+            if workers > 1:
+                frames = render_world_map_frames_parallel(world, panel, num_show_name, dates, workers,
+                                                          figsize=fig.get_size_inches(), dpi=fig.dpi, geometry_index=geometry_index)
+            else:
+                renderer = WorldMapRenderer(world, panel, num_show_name, figsize=fig.get_size_inches(), dpi=fig.dpi,
+                                            geometry_index=geometry_index)
+                frames = (renderer.render(date) for date in dates)
+            for frame in tqdm(frames, total=len(dates), desc="Processing dates", unit="date"):
+                writer.write(frame)
+        else:
+            # Generate frames for each date
+            for date in tqdm(dates, desc="Processing dates", unit="date"):
+                ax.clear()  # Clear the axis for each frame
+                plot_world_map_with_circles(fig, ax, df_cd, world, date, num_show_name, panel=panel,
+                                            geometry_index=geometry_index)
+            
+                # Save the current frame to a BytesIO buffer
+                buf = io.BytesIO()
+                plt.savefig(buf, format='png', bbox_inches='tight', pad_inches=0)
+                buf.seek(0)
+                writer.write(Image.open(buf))
     
     print(f"Animation saved as {output_file}")
 
 
-
-
-
-
-
+# Cases shown on the map for one date, for every country of the panel (NaN where there is no data):
+# the day's new cases, or the average of the last 7 days when they are zero (see td.new_cases_display).
+def map_cases(panel, date):
+    date = pd.Timestamp(date)
+    if date not in panel.date_index:
+        return np.full(len(panel.countries), np.nan)
+    return panel.values['new_cases_display'][panel.date_index[date]]
+
+
+# World map animation frames, drawn with blitting on an off-screen Agg figure: the basemap and the country
+# centroids are computed and drawn once, and each frame only updates the offsets and sizes of one scatter
+# collection, the country labels and the title.
+class WorldMapRenderer:
+
+    # geometry_index: optional GeometryIndex of the shapefile, built from world if not given.
+    def __init__(self, world, panel, num_show_name, figsize = (12, 8), dpi = 100, geometry_index = None):
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+        self.panel = panel
+        self.num_show_name = num_show_name
+        self.fig = Figure(figsize=figsize, dpi=dpi)
+        self.canvas = FigureCanvasAgg(self.fig)
+        self.ax = self.fig.add_subplot()
+        self.fig.subplots_adjust(left=0, right=1, bottom=0, top=0.94)
+
+        # basemap, with the limits fixed so the circles don't rescale the axes.
+        world.plot(ax=self.ax, color='lightgray')
+        self.ax.set_axis_off()
+        self.ax.autoscale(False)
+
+        # centroids of the panel's countries found in the shapefile.
+        if geometry_index is None:
+            geometry_index = build_geometry_index(world)
+        rows = geometry_index.lookup(panel.countries)
+        self.columns = np.flatnonzero(rows >= 0)
+        self.centroids = geometry_index.centroids[rows[self.columns]]
+
+        # per-frame artists, left out of the background.
+        self.scatter = self.ax.scatter([], [], s=[], color='red', alpha=0.5, animated=True)
+        self.labels = [self.ax.text(x, y, panel.countries[j], fontsize=8, ha='center', color='black', animated=True)
+                       for j, (x, y) in zip(self.columns, self.centroids)]
+        self.title = self.ax.set_title('', animated=True)
+
+        self.canvas.draw()
+        self.background = self.canvas.copy_from_bbox(self.fig.bbox)
+
+    # the frame for one date, as an RGB image.
+    def render(self, date):
+        from PIL import Image
+
+        cases = map_cases(self.panel, date)[self.columns]
+        shown = ~np.isnan(cases)
+        self.canvas.restore_region(self.background)
+
+        # Create a circle at the centroid location with size based on cases
+        self.scatter.set_offsets(self.centroids[shown])
+        self.scatter.set_sizes(cases[shown] / 250)
+        self.ax.draw_artist(self.scatter)
+
+        # Add the country's name above the circle if cases exceed num_show_name
+        for label, (x, y), c in zip(self.labels, self.centroids, cases):
+            if c > self.num_show_name:
+                circle_radius = c / 250
+                label.set_position((x, y + (circle_radius / 100)))
+                self.ax.draw_artist(label)
+
+        self.title.set_text(f"COVID-19 Cases by Country on {pd.Timestamp(date).strftime('%Y-%m-%d')}")
+        self.ax.draw_artist(self.title)
+        self.canvas.blit(self.fig.bbox)
+        return Image.fromarray(np.asarray(self.canvas.buffer_rgba())[..., :3].copy())
+
+
+# World map frames drawn in worker processes and yielded in date order. The dates are split into chunks,
+# and each worker builds its renderer (figure, basemap and centroids) once. At most two chunks per worker
+# are in flight, so memory stays bounded however many dates there are.
+# gif_encoder: optional GifFrameEncoder (palette, size and delay of a GifWriter); the workers then also
+# encode the frames and the encoded bytes are yielded instead of the images.
+def render_world_map_frames_parallel(world, panel, num_show_name, dates, workers, figsize = (12, 8), dpi = 100, chunk_size = None,
+                                    geometry_index = None, gif_encoder = None):
+    from PIL import Image
+
+    if chunk_size is None:
+        chunk_size = max(1, int(np.ceil(len(dates) / (workers * 4))))
+    chunks = [dates[i:i + chunk_size] for i in range(0, len(dates), chunk_size)]
+    encoder_args = None if gif_encoder is None else (gif_encoder.palette, gif_encoder.size, gif_encoder.delay)
+    result = (lambda frame: frame) if gif_encoder is not None else Image.fromarray
+
+    with ProcessPoolExecutor(workers, initializer=_init_render_worker,
+                             initargs=(world, panel, num_show_name, tuple(figsize), dpi, geometry_index, encoder_args)) as executor:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(executor.submit(_render_chunk, chunk))
+            if len(pending) >= 2 * workers:
+                for frame in pending.popleft().result():
+                    yield result(frame)
+        while pending:
+            for frame in pending.popleft().result():
+                yield result(frame)
+
+
+_worker_renderer = None
+_worker_encoder = None
+
+
+def _init_render_worker(world, panel, num_show_name, figsize, dpi, geometry_index, encoder_args):
+    global _worker_renderer, _worker_encoder
+    import matplotlib
+    matplotlib.use('Agg')
+    _worker_renderer = WorldMapRenderer(world, panel, num_show_name, figsize=figsize, dpi=dpi, geometry_index=geometry_index)
+    if encoder_args is not None:
+        _worker_encoder = GifFrameEncoder(*encoder_args)
+
+
+def _render_chunk(dates):
+    if _worker_encoder is not None:
+        return [_worker_encoder.encode(_worker_renderer.render(date)) for date in dates]
+    return [np.asarray(_worker_renderer.render(date)) for date in dates]
+
+
+# Country geometry index
+#--------------------------------
+# Centroids, representative points (always inside the country) and bounding boxes of every country of the
+# Natural Earth shapefile, as arrays with one row per ADMIN name. OWID names that differ from the
+# shapefile's are translated with owid_to_natural_earth.
+
+owid_to_natural_earth = {
+    'United States': 'United States of America',
+    'Bahamas': 'The Bahamas',
+    "Cote d'Ivoire": 'Ivory Coast',
+    'Democratic Republic of Congo': 'Democratic Republic of the Congo',
+    'Congo': 'Republic of the Congo',
+    'Eswatini': 'eSwatini',
+    'Serbia': 'Republic of Serbia',
+    'Tanzania': 'United Republic of Tanzania',
+    'Timor': 'East Timor',
+}
+
+shapefile = 'ne_110m_admin_0_countries/ne_110m_admin_0_countries.shp'
+
+
+class GeometryIndex:
+
+    def __init__(self, names, centroids, representative_points, bounds):
+        self.names = names  # ADMIN names
+        self.centroids = centroids  # (n, 2) x, y
+        self.representative_points = representative_points  # (n, 2) x, y
+        self.bounds = bounds  # (n, 4) minx, miny, maxx, maxy
+        self.row = {name: i for i, name in enumerate(names)}
+
+    # rows of the given (OWID) country names, -1 for countries not in the shapefile.
+    def lookup(self, countries):
+        return np.array([self.row.get(owid_to_natural_earth.get(country, country), -1) for country in countries], dtype=int)
+
+
+def build_geometry_index(world):
+    geometries = list(world.geometry)
+    centroids = np.array([(g.centroid.x, g.centroid.y) for g in geometries]).reshape(-1, 2)
+    representative_points = np.array([(p.x, p.y) for p in (g.representative_point() for g in geometries)]).reshape(-1, 2)
+    bounds = np.array([g.bounds for g in geometries]).reshape(-1, 4)
+    return GeometryIndex(np.array(world['ADMIN'], dtype=str), centroids, representative_points, bounds)
+
+
+# the index of a shapefile, read from the .npz stored next to it, or built (and stored) when that file is
+# missing or was built from another version of the shapefile.
+def load_geometry_index(path = shapefile):
+    index_path = os.path.splitext(path)[0] + '.index.npz'
+    source_hash = _shapefile_hash(path)
+    if os.path.exists(index_path):
+        with np.load(index_path) as data:
+            if str(data['source_hash']) == source_hash:
+                return GeometryIndex(data['names'], data['centroids'], data['representative_points'], data['bounds'])
+
+    import geopandas as gpd
+    index = build_geometry_index(gpd.read_file(path))
+    np.savez(index_path, names=index.names, centroids=index.centroids, representative_points=index.representative_points,
+             bounds=index.bounds, source_hash=source_hash)
+    return index
+
+
+def _shapefile_hash(path):
+    h = hashlib.sha256()
+    for extension in ['.shp', '.dbf']:
+        with open(os.path.splitext(path)[0] + extension, 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+
+# Streaming animation writers
+#--------------------------------
+# Frames are encoded as they arrive, so memory doesn't grow with the number of frames. Frames of another
+# size than the first one are cropped or padded (with white) to it.
+
+# writer for output_file, chosen from its extension: .gif, or .mp4 / .webm (needs ffmpeg).
+# duration: time each frame is shown, in milliseconds.
+def open_animation_writer(output_file, duration = 500):
+    extension = os.path.splitext(output_file)[1].lower()
+    if extension == '.gif':
+        return GifWriter(output_file, duration)
+    if extension in ('.mp4', '.webm'):
+        return FfmpegWriter(output_file, duration)
+    raise ValueError(f"unsupported animation format '{extension}' (use .gif, .mp4 or .webm)")
+
+
+def _fit_frame(frame, size):
+    from PIL import Image
+
+    frame = frame.convert('RGB')
+    if size is not None and frame.size != size:
+        fitted = Image.new('RGB', size, 'white')
+        fitted.paste(frame, (0, 0))
+        frame = fitted
+    return frame
+
+
+# GIF written frame by frame, every frame mapped to one palette (built from the first frame) stored as the
+# global color table. Each frame is encoded by a GifFrameEncoder and its bytes are appended to the file, so
+# frames encoded elsewhere (e.g. in the workers of render_world_map_frames_parallel) can be written in order.
+class GifWriter:
+
+    def __init__(self, output_file, duration = 500, loop = 0):
+        self.file = open(output_file, 'wb')
+        self.delay = int(round(duration / 10))  # GIF delays are in hundredths of a second
+        self.loop = loop
+        self.size = None
+        self.palette = None
+        self.encoder = None
+
+    def write(self, frame):
+        frame = _fit_frame(frame, self.size)
+        if self.palette is None:
+            self.size = frame.size
+            self.palette = frame.quantize(colors=256).getpalette()[:768]
+            self.encoder = GifFrameEncoder(self.palette, self.size, self.delay)
+            self._write_header()
+        self.file.write(self.encoder.encode(frame))
+
+    # a frame already encoded by a GifFrameEncoder with this writer's palette, size and delay.
+    def write_encoded(self, data):
+        self.file.write(data)
+
+    def _write_header(self):
+        width, height = self.size
+        palette = bytes(self.palette).ljust(768, b'\x00')
+        self.file.write(b'GIF89a' + width.to_bytes(2, 'little') + height.to_bytes(2, 'little'))
+        self.file.write(b'\xf7\x00\x00' + palette)  # global color table of 256 colors
+        self.file.write(b'\x21\xff\x0bNETSCAPE2.0\x03\x01' + self.loop.to_bytes(2, 'little') + b'\x00')
+
+    def close(self):
+        if self.palette is not None:
+            self.file.write(b'\x3b')
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# Encoder of the frames of a GIF: each frame is fitted to size, mapped to the palette (a list of up to 768
+# RGB values) and returned as the bytes of its graphics control extension (the delay), image descriptor
+# and LZW data.
+class GifFrameEncoder:
+
+    def __init__(self, palette, size, delay):
+        self.palette = palette
+        self.size = size
+        self.delay = delay
+        self.lookup = None
+
+    def encode(self, frame):
+        indexed = self._indexed(_fit_frame(frame, self.size))
+        return b'\x21\xf9\x04\x00' + self.delay.to_bytes(2, 'little') + b'\x00\x00' + self._image_block(indexed)
+
+    # frame mapped to the nearest palette colors. The palette index of every color seen so far is kept in a
+    # lookup table over all 2**24 RGB colors, so each distinct color is matched only once.
+    def _indexed(self, frame):
+        from PIL import Image
+
+        rgb = np.asarray(frame, dtype=np.int32)
+        codes = (rgb[..., 0] << 16) | (rgb[..., 1] << 8) | rgb[..., 2]
+        if self.lookup is None:
+            self.lookup = np.full(1 << 24, -1, dtype=np.int16)
+        index = self.lookup[codes]
+        missing = index < 0
+        if missing.any():
+            colors = np.unique(codes[missing])
+            colors_rgb = np.stack([colors >> 16, (colors >> 8) & 255, colors & 255], axis=1)
+            palette = np.array(self.palette).reshape(-1, 3)
+            self.lookup[colors] = ((colors_rgb[:, None, :] - palette[None, :, :])**2).sum(axis=2).argmin(axis=1)
+            index = self.lookup[codes]
+        indexed = Image.fromarray(index.astype(np.uint8), mode='P')
+        indexed.putpalette(self.palette)
+        return indexed
+
+    # image descriptor and LZW data of a single-frame GIF encoded by PIL with the shared palette.
+    def _image_block(self, indexed):
+        buf = io.BytesIO()
+        indexed.save(buf, format='GIF', optimize=False)
+        data = buf.getvalue()
+        i = 13 + (3 << ((data[10] & 7) + 1) if data[10] & 0x80 else 0)
+        while data[i] == 0x21:  # skip extensions
+            i += 2
+            while data[i]:
+                i += data[i] + 1
+            i += 1
+        return data[i:-1]  # up to the trailer
+
+
+# MP4 (H.264) or WebM (VP9) written by piping raw frames to a local ffmpeg.
+class FfmpegWriter:
+
+    def __init__(self, output_file, duration = 500, ffmpeg = 'ffmpeg'):
+        if shutil.which(ffmpeg) is None:
+            raise RuntimeError(f"'{ffmpeg}' not found, it is needed to write {output_file}")
+        self.output_file = output_file
+        self.fps = 1000 / duration
+        self.ffmpeg = ffmpeg
+        self.size = None
+        self.process = None
+
+    def write(self, frame):
+        frame = _fit_frame(frame, self.size)
+        if self.process is None:
+            self.size = frame.size
+            self._start()
+        self.process.stdin.write(frame.tobytes())
+
+    def _start(self):
+        width, height = self.size
+        codec = ['-c:v', 'libvpx-vp9'] if self.output_file.lower().endswith('.webm') else ['-c:v', 'libx264']
+        command = [self.ffmpeg, '-y', '-loglevel', 'error',
+                   '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-s', f'{width}x{height}', '-r', f'{self.fps}', '-i', '-',
+                   '-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2:color=white', *codec, '-pix_fmt', 'yuv420p', self.output_file]
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE)
+
+    def close(self):
+        if self.process is not None:
+            self.process.stdin.close()
+            if self.process.wait() != 0:
+                raise RuntimeError(f"ffmpeg failed to write {self.output_file}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -1,12 +1,22 @@
 import numpy as np
 import pandas as pd
-import networkx as nx
-import matplotlib.pyplot as plt
-from mpl_toolkits.mplot3d import Axes3D
-import seaborn as sns
+from concurrent.futures import ProcessPoolExecutor
+# matplotlib is imported by the plotting functions, so the analyses can be imported without it.
+
+import transform_data as td
 
 # present the cases and deaths correlations for different countries.
 def plot_cd_correlation_vax_rate(max_lagged_corr, v_low, v_high, country_list):
+    import matplotlib.pyplot as plt
+
+    fig, ax = plt.subplots(figsize=(10, 6))
+    draw_cd_correlation_vax_rate(ax, max_lagged_corr, v_low, v_high, country_list)
+    fig.savefig('correlation_data.png')
+    plt.show()
+
+
+# the chart of plot_cd_correlation_vax_rate drawn onto ax.
+def draw_cd_correlation_vax_rate(ax, max_lagged_corr, v_low, v_high, country_list):
     # Extract data from max_lagged_corr dictionary
     corr_values_vlow = [max_lagged_corr[c][1] for c in country_list]  # Max correlation before vaccination
     corr_values_vhigh = [max_lagged_corr[c][3] for c in country_list]  # Max correlation after vaccination
@@ -14,128 +24,440 @@ def plot_cd_correlation_vax_rate(max_lagged_corr, v_low, v_high, country_list):
     # Define y positions for each country
     y_positions = np.arange(len(country_list))
     
-    plt.figure(figsize=(10, 6))
-    
     # Draw lines connecting the two points for each country (drawn first, so they go under scatter points)
     for i in range(len(country_list)):
-        plt.plot([corr_values_vlow[i], corr_values_vhigh[i]], [y_positions[i], y_positions[i]], 
-                 color='black', linestyle='-', alpha=0.5, zorder=1)
+        ax.plot([corr_values_vlow[i], corr_values_vhigh[i]], [y_positions[i], y_positions[i]], 
+                color='black', linestyle='-', alpha=0.5, zorder=1)
     
     # Plot max_corr_value_vlow (before vaccination) - larger circles
-    plt.scatter(corr_values_vlow, y_positions, color='blue', label='Before Vaccination (v_low)', 
-                s=100, edgecolors='black', zorder=2)
+    ax.scatter(corr_values_vlow, y_positions, color='blue', label='Before Vaccination (v_low)', 
+               s=100, edgecolors='black', zorder=2)
     
     # Plot max_corr_value_vhigh (after vaccination) - larger circles
-    plt.scatter(corr_values_vhigh, y_positions, color='red', label='After Vaccination (v_high)', 
-                s=100, edgecolors='black', zorder=2)
+    ax.scatter(corr_values_vhigh, y_positions, color='red', label='After Vaccination (v_high)', 
+               s=100, edgecolors='black', zorder=2)
     
     # Formatting
-    plt.yticks(y_positions, country_list, fontsize=12)  # Increase fontsize for country names
-    plt.xlabel("Maximum correlation", fontsize=12)
-    plt.title(f"Correlation between cases and deaths before {v_low*100}% (blue) and after {v_high*100}% (red) vaccinated.")
-    plt.axvline(0, color='gray', linestyle='--', linewidth=0.8)  # Reference line at 0
-    plt.grid(axis='x', linestyle='--', alpha=0.6)
+    ax.set_yticks(y_positions, country_list, fontsize=12)  # Increase fontsize for country names
+    ax.set_xlabel("Maximum correlation", fontsize=12)
+    ax.set_title(f"Correlation between cases and deaths before {v_low*100}% (blue) and after {v_high*100}% (red) vaccinated.")
+    ax.axvline(0, color='gray', linestyle='--', linewidth=0.8)  # Reference line at 0
+    ax.grid(axis='x', linestyle='--', alpha=0.6)
 
-    plt.savefig('correlation_data.png')
-    plt.show()
+
+# the chart of plot_cd_correlation_vax_rate drawn off screen (no pyplot figure, nothing shown) and written to output_file.
+def save_cd_correlation_vax_rate(max_lagged_corr, v_low, v_high, country_list, output_file = 'correlation_data.png'):
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    fig = Figure(figsize=(10, 6))
+    FigureCanvasAgg(fig)
+    draw_cd_correlation_vax_rate(fig.add_subplot(), max_lagged_corr, v_low, v_high, country_list)
+    fig.savefig(output_file)
+    return output_file
 
 
 # for the countries in country_list look at the low and high vaccination periods and find the maximum correlation between cases and deashs
-def find_cd_correlations_for_vax_rate(df_cd, df_vac, v_low, v_high, max_lag, country_list):
+# panel: a td.CovidPanel of df_cd and df_vac, built here if not given.
+def find_cd_correlations_for_vax_rate(df_cd, df_vac, v_low, v_high, max_lag, country_list, panel = None):
     max_lagged_corr = {}
+    if panel is None:
+        panel = td.build_panel(df_cd, df_vac)
     
-    for country in country_list:
-        subset = df_vac[df_vac['country'] == country]
-        vax_low_date = subset.loc[subset['people_fully_vaccinated_per_hundred'] <= v_low, 'date'].max()
-        vax_high_date = subset.loc[subset['people_fully_vaccinated_per_hundred'] >= v_high, 'date'].min()
-        
-        # Convert base country's 'feature' (e.g., cases) into a time series
-        df_cases = df_cd.pivot(index='date', columns='country', values='new_cases')
-        df_deaths = df_cd.pivot(index='date', columns='country', values='new_deaths')
-        
-        cases_series = df_cases[country]
-        deaths_series = df_deaths[country]
-        
-        # Define the date range
-        first_date = cases_series.index.min()  # Earliest date in the dataset
-        last_date = cases_series.index.max()
-        
-        # Restrict data to the period before and after vax_low_date
-        cases_series_vlow = cases_series.loc[first_date:vax_low_date]
-        deaths_series_vlow = deaths_series.loc[first_date:vax_low_date]
-        
-        cases_series_vhigh = cases_series.loc[vax_high_date:last_date]
-        deaths_series_vhigh = deaths_series.loc[vax_high_date:last_date]
-        
-        lagged_corrs_vlow = {}
-        lagged_corrs_vhigh = {}
-        # Loop through lags and calculate correlations
-        for lag in range(0, max_lag + 1):
-            shifted_cases_series_vlow = cases_series_vlow.shift(lag)
-            shifted_cases_series_vhigh = cases_series_vhigh.shift(lag)
-        
-            # Normalized correlation
-            corr_value_vlow = shifted_cases_series_vlow.corr(deaths_series_vlow)
-            corr_value_vhigh = shifted_cases_series_vhigh.corr(deaths_series_vhigh)
-    
-            # Handle NaN values
-            lagged_corrs_vlow[lag] = 0 if pd.isna(corr_value_vlow) else corr_value_vlow
-            lagged_corrs_vhigh[lag] = 0 if pd.isna(corr_value_vhigh) else corr_value_vhigh
+    # Restrict data to the period before vax_low_date and after vax_high_date of each country
+    vlow_period, vhigh_period = vax_rate_periods(panel, v_low, v_high, country_list)
+
+    # lag x country correlations of the two periods, for every lag at once
+    lagged_corrs_vlow = cd_lagged_correlations(panel, max_lag, country_list, vlow_period)
+    lagged_corrs_vhigh = cd_lagged_correlations(panel, max_lag, country_list, vhigh_period)
+
+    for j, country in enumerate(country_list):
+        # Handle NaN values
+        corrs_vlow = np.nan_to_num(lagged_corrs_vlow.to_numpy()[:, j], nan=0)
+        corrs_vhigh = np.nan_to_num(lagged_corrs_vhigh.to_numpy()[:, j], nan=0)
         
         # Find the max correlation and corresponding lag
-        max_lag_index_vlow = max(lagged_corrs_vlow, key=lagged_corrs_vlow.get)
-        max_corr_value_vlow = lagged_corrs_vlow[max_lag_index_vlow]
-        max_lag_index_vhigh = max(lagged_corrs_vhigh, key=lagged_corrs_vhigh.get)
-        max_corr_value_vhigh = lagged_corrs_vhigh[max_lag_index_vhigh]
+        max_lag_index_vlow = int(np.argmax(corrs_vlow))
+        max_corr_value_vlow = corrs_vlow[max_lag_index_vlow]
+        max_lag_index_vhigh = int(np.argmax(corrs_vhigh))
+        max_corr_value_vhigh = corrs_vhigh[max_lag_index_vhigh]
     
         # record maximum lags for each country
         max_lagged_corr[country] = [max_lag_index_vlow, max_corr_value_vlow, max_lag_index_vhigh, max_corr_value_vhigh]
     return max_lagged_corr
 
 
+# date x country masks of the low (up to the last date at or below v_low) and high (from the first date at 
+# or above v_high) vaccination periods. A country that is never at or below v_low keeps all its dates in the
+# low period, one that never reaches v_high has an empty high period.
+# crossing_index: optional td.CrossingIndex of people_fully_vaccinated_per_hundred, built here if not given.
+def vax_rate_periods(panel, v_low, v_high, country_list, crossing_index = None):
+    if crossing_index is None:
+        crossing_index = td.build_crossing_index(panel, 'people_fully_vaccinated_per_hundred')
+    cols = [panel.country_index[country] for country in country_list]
+    vax_low_rows = crossing_index.last_rows(v_low)[0, cols]
+    vax_high_rows = crossing_index.first_rows(v_high)[0, cols]
+    vax_low_rows[vax_low_rows < 0] = len(panel.dates) - 1  # never at or below v_low: every date
+
+    rows = np.arange(len(panel.dates))[:, None]
+    return rows <= vax_low_rows, rows >= vax_high_rows
+
+
+# lag x country correlation between new cases shifted by lag days and new deaths, for lags 0..max_lag.
+# period: optional date x country mask restricting the dates of each country, as slicing the series would.
+# Undefined correlations (too few points, constant data) are NaN, as Series.corr gives them.
+def cd_lagged_correlations(panel, max_lag, country_list = None, period = None, method = 'fft'):
+    if country_list is None:
+        country_list = list(panel.countries)
+    cols = [panel.country_index[country] for country in country_list]
+    cases = panel.values['new_cases'][:, cols]
+    deaths = panel.values['new_deaths'][:, cols]
+    if period is not None:
+        cases = np.where(period, cases, np.nan)
+        deaths = np.where(period, deaths, np.nan)
+
+    corrs = lagged_correlation(cases, deaths, max_lag, method)
+    return pd.DataFrame(corrs, index=pd.RangeIndex(max_lag + 1, name='lag'), columns=country_list)
+
+
+# date x country matrices of the best-lag correlation between new cases and new deaths in a sliding window,
+# and of that lag (0..max_lag): at each date, over the pairs (cases[t - lag], deaths[t]) for the window days
+# of deaths t ending at that date. NaN where no lag has min_periods pairs (window // 2 by default) and variance.
+# The window sums are running sums differenced, so each window costs the same whatever its length, and the
+# lags are done one at a time for all dates and countries together.
+def rolling_cd_lagged_correlations(panel, max_lag, window = 90, country_list = None, min_periods = None):
+    if country_list is None:
+        country_list = list(panel.countries)
+    if min_periods is None:
+        min_periods = window // 2
+    x, y, mx, my = _centred_cases_deaths(panel, country_list)
+
+    best_corr = np.full(x.shape, -np.inf)
+    best_lag = np.full(x.shape, np.nan)
+    for lag in range(min(max_lag, len(x) - 1) + 1):
+        (n, _), (sx, _), (sy, _), (sxx, running_xx), (syy, running_yy), (sxy, _) = [
+            _window_sums(a, window) for a in _lagged_products(x, y, mx, my, lag)]
+
+        # the rounding noise of a window sum is that of the running sums it is taken from.
+        corr = _correlation_from_sums(n, sx, sy, sxx, syy, sxy, 1e-10 * running_xx, 1e-10 * running_yy, min_periods)
+        better = corr > best_corr
+        best_corr[better] = corr[better]
+        best_lag[better] = lag
+
+    best_corr[np.isinf(best_corr)] = np.nan
+    return (pd.DataFrame(best_corr, index=panel.dates, columns=country_list),
+            pd.DataFrame(best_lag, index=panel.dates, columns=country_list))
+
+
+# sums of a over the trailing windows of `window` rows, and the running sums they are taken from.
+def _window_sums(a, window):
+    running = np.cumsum(a, axis=0)
+    sums = running.copy()
+    sums[window:] -= running[:-window]
+    return sums, running
+
+
+# Threshold sweep
+#--------------------------------
+# find_cd_correlations_for_vax_rate for every v_low of v_lows and v_high of v_highs. A country's low period is
+# a prefix of its dates and its high period a suffix, so the sums over the pairs (cases[t - lag], deaths[t]) of
+# a period are differences of running sums over t: these are computed once per lag for all dates and
+# countries, and each (threshold, country) then reads max_lag + 1 values of them instead of going through
+# its whole series again.
+# Rows (v_low, v_high, country), with the lag and max correlation of each period and corr_gap (high - low).
+def sweep_cd_correlations_for_vax_rate(df_cd, df_vac, v_lows, v_highs, max_lag, country_list, panel = None):
+    if panel is None:
+        panel = td.build_panel(df_cd, df_vac)
+    v_lows, v_highs = np.atleast_1d(v_lows), np.atleast_1d(v_highs)
+    n_dates, n_countries = len(panel.dates), len(country_list)
+    cols = [panel.country_index[country] for country in country_list]
+    country_cols = np.arange(n_countries)
+
+    # last row of each low period and first row of each high period (n_dates when there is none).
+    crossing_index = td.build_crossing_index(panel, 'people_fully_vaccinated_per_hundred')
+    low_rows = crossing_index.last_rows(v_lows)[:, cols]
+    low_rows[low_rows < 0] = n_dates - 1  # never at or below v_low: every date
+    high_rows = crossing_index.first_rows(v_highs)[:, cols]
+
+    x, y, mx, my = _centred_cases_deaths(panel, country_list)
+    low_sums = np.zeros((6, len(v_lows), max_lag + 1, n_countries))
+    high_sums = np.zeros((6, len(v_highs), max_lag + 1, n_countries))
+    running = np.zeros((n_dates + 1, n_countries))  # running[t]: sum over the rows before t
+    for lag in range(min(max_lag, n_dates - 1) + 1):
+        for k, products in enumerate(_lagged_products(x, y, mx, my, lag)):
+            np.cumsum(products, axis=0, out=running[1:])
+            low_sums[k, :, lag] = running[low_rows + 1, country_cols]
+            high_sums[k, :, lag] = running[n_dates] - running[np.minimum(high_rows + lag, n_dates), country_cols]
+
+    # tolerances of the variances, from the sums of squares over each period.
+    np.cumsum(x * x, axis=0, out=running[1:])
+    low_tol_x, high_tol_x = running[low_rows + 1, country_cols], running[n_dates] - running[high_rows, country_cols]
+    np.cumsum(y * y, axis=0, out=running[1:])
+    low_tol_y, high_tol_y = running[low_rows + 1, country_cols], running[n_dates] - running[high_rows, country_cols]
+
+    low_corr, low_lag = _max_over_lags(_correlation_from_sums(*low_sums, 1e-10 * low_tol_x[:, None], 1e-10 * low_tol_y[:, None]))
+    high_corr, high_lag = _max_over_lags(_correlation_from_sums(*high_sums, 1e-10 * high_tol_x[:, None], 1e-10 * high_tol_y[:, None]))
+
+    # one row per (v_low, v_high, country)
+    i, k = [a.ravel() for a in np.meshgrid(np.arange(len(v_lows)), np.arange(len(v_highs)), indexing='ij')]
+    return pd.DataFrame({'v_low': np.repeat(v_lows[i], n_countries), 'v_high': np.repeat(v_highs[k], n_countries),
+                         'country': np.tile(np.asarray(country_list, dtype=object), len(i)),
+                         'lag_low': low_lag[i].ravel(), 'corr_low': low_corr[i].ravel(),
+                         'lag_high': high_lag[k].ravel(), 'corr_high': high_corr[k].ravel(),
+                         'corr_gap': (high_corr[k] - low_corr[i]).ravel()})
+
+
+# maximum correlation over the lags (axis 1, NaN taken as 0 as in find_cd_correlations_for_vax_rate) and its lag.
+def _max_over_lags(corrs):
+    corrs = np.nan_to_num(corrs, nan=0)
+    lags = np.argmax(corrs, axis=1)
+    return np.take_along_axis(corrs, lags[:, None], axis=1)[:, 0], lags
+
+
+# Vectorized lagged correlation
+#--------------------------------
+# For every lag L and column, the Pearson correlation of the pairs (x[t - L], y[t]) where both are
+# non-NaN, i.e. x.shift(L).corr(y) on each column. Everything needed is six lagged sums of products
+# over the valid pairs (count, sums, sums of squares and cross products), computed for all lags and
+# columns together, either with FFTs ('fft') or one slice per lag ('direct').
+
+# weights: optional (time x column) weights of the pairs, by the time t of y (a column of x or y may then be
+# shared by all columns, e.g. one country's series with one column of weights per bootstrap replicate).
+def lagged_correlation(x, y, max_lag, method = 'fft', weights = None):
+    x = np.asarray(x, dtype='float64')
+    y = np.asarray(y, dtype='float64')
+    if x.ndim == 1:
+        return lagged_correlation(x[:, None], y[:, None], max_lag, method, weights)[:, 0]
+    valid_x = ~np.isnan(x)
+    valid_y = ~np.isnan(y)
+
+    # centre each column, so the sums below don't lose precision to large case counts.
+    with np.errstate(invalid='ignore'):
+        x = np.where(valid_x, x - _nanmean(x), 0)
+        y = np.where(valid_y, y - _nanmean(y), 0)
+    mx, my = valid_x.astype('float64'), valid_y.astype('float64')
+    w = 1 if weights is None else weights
+    wmy, wy = w * my, w * y
+
+    lagged_sum = _lagged_sums_fft if method == 'fft' else _lagged_sums_direct
+    sums = lagged_sum([mx, x, mx, x * x, mx, x], [wmy, wmy, wy, wmy, wy * y, wy], max_lag)
+
+    # tolerances of the variances: the rounding noise of sums of this size.
+    w_max = 1 if weights is None else weights.max(axis=0)
+    return _correlation_from_sums(*sums, 1e-10 * (x * x).sum(axis=0) * w_max, 1e-10 * (wy * y).sum(axis=0))
+
+
+# Pearson correlation from the six sums over the pairs (count, sums, sums of squares and cross products).
+# Undefined (NaN): fewer than min_pairs pairs, or a variance at or below its tolerance (rounding noise).
+def _correlation_from_sums(n, sx, sy, sxx, syy, sxy, tol_x, tol_y, min_pairs = 2):
+    n = np.rint(n)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        cov = sxy - sx * sy / n
+        var_x = sxx - sx * sx / n
+        var_y = syy - sy * sy / n
+        corr = np.clip(cov / np.sqrt(var_x * var_y), -1, 1)
+    corr[(n < max(min_pairs, 2)) | (var_x <= tol_x) | (var_y <= tol_y)] = np.nan
+    return corr
+
+
+# new cases and deaths of the countries, centred, with NaNs as 0 and their masks (mx, my) of valid values.
+def _centred_cases_deaths(panel, country_list):
+    cols = [panel.country_index[country] for country in country_list]
+    x = panel.values['new_cases'][:, cols]
+    y = panel.values['new_deaths'][:, cols]
+    valid_x, valid_y = ~np.isnan(x), ~np.isnan(y)
+    with np.errstate(invalid='ignore'):
+        x = np.where(valid_x, x - _nanmean(x), 0)
+        y = np.where(valid_y, y - _nanmean(y), 0)
+    return x, y, valid_x.astype('float64'), valid_y.astype('float64')
+
+
+# the six products of the pairs (x[t - lag], y[t]) at each t, whose sums _correlation_from_sums takes
+# (0 where t < lag or a value is missing).
+def _lagged_products(x, y, mx, my, lag):
+    x_lag, mx_lag = np.zeros_like(x), np.zeros_like(mx)
+    x_lag[lag:], mx_lag[lag:] = x[:len(x) - lag], mx[:len(x) - lag]
+    return [mx_lag * my, x_lag * my, mx_lag * y, x_lag * x_lag * my, mx_lag * y * y, x_lag * y]
+
+
+def _nanmean(a):
+    count = (~np.isnan(a)).sum(axis=0)
+    return np.where(count > 0, np.nansum(a, axis=0) / np.maximum(count, 1), 0)
+
+
+# sum over t of a[t - L] * b[t] for L = 0..max_lag, for each pair of (time x column) arrays.
+def _lagged_sums_fft(a_list, b_list, max_lag):
+    n = a_list[0].shape[0]
+    size = 1 << int(np.ceil(np.log2(max(n + max_lag, 1))))  # no wrap-around for lags up to max_lag
+    sums = []
+    for a, b in zip(a_list, b_list):
+        spectrum = np.conj(np.fft.rfft(a, size, axis=0)) * np.fft.rfft(b, size, axis=0)
+        sums.append(np.fft.irfft(spectrum, size, axis=0)[:max_lag + 1])
+    return sums
+
+
+def _lagged_sums_direct(a_list, b_list, max_lag):
+    n = a_list[0].shape[0]
+    sums = []
+    for a, b in zip(a_list, b_list):
+        lagged = np.zeros((max_lag + 1, np.broadcast_shapes(a.shape, b.shape)[1]))
+        for lag in range(min(max_lag, n - 1) + 1):
+            lagged[lag] = (a[:n - lag] * b[lag:]).sum(axis=0)
+        sums.append(lagged)
+    return sums
+
+
+
+
+# Block bootstrap of the maximum lagged correlation
+#--------------------------------
+# Each replicate resamples, in blocks of block_length consecutive days, the dates of a country's low or high
+# vaccination period, and finds the maximum correlation and its lag for the pairs (cases[t - lag], deaths[t])
+# at the resampled dates t. A resampled date only changes how often each pair counts, so a replicate is the
+# lagged correlation with one weight per date, and batch_size replicates are computed together as the
+# columns of one lagged_correlation call. Countries are spread over workers processes. Every country draws
+# its replicates from its own seed, spawned from seed, so the results don't depend on the number of workers.
+
+# rows (country, period) with the point estimates of find_cd_correlations_for_vax_rate (max_corr, lag) and
+# their confidence intervals (max_corr_low, max_corr_high, lag_low, lag_high).
+def bootstrap_cd_correlations_for_vax_rate(df_cd, df_vac, v_low, v_high, max_lag, country_list, n_boot = 1000,
+                                           block_length = 14, confidence = 0.95, seed = 0, workers = 1,
+                                           batch_size = 100, panel = None):
+    if panel is None:
+        panel = td.build_panel(df_cd, df_vac)
+    periods = dict(zip(['low', 'high'], vax_rate_periods(panel, v_low, v_high, country_list)))
+    seeds = np.random.SeedSequence(seed).spawn(len(country_list))
+
+    tasks = []
+    for j, country in enumerate(country_list):
+        cases = panel.series('new_cases', country).to_numpy()
+        deaths = panel.series('new_deaths', country).to_numpy()
+        for mask, period_seed in zip(periods.values(), seeds[j].spawn(len(periods))):
+            tasks.append((cases, deaths, mask[:, j], max_lag, n_boot, block_length, batch_size, period_seed))
+
+    if workers > 1:
+        with ProcessPoolExecutor(workers) as executor:
+            results = list(executor.map(_bootstrap_max_correlation, *zip(*tasks), chunksize=2))
+    else:
+        results = [_bootstrap_max_correlation(*task) for task in tasks]
+
+    tail = 100 * (1 - confidence) / 2
+    rows = []
+    for (country, period), (point, replicates) in zip([(c, p) for c in country_list for p in periods], results):
+        corr_low, corr_high = np.percentile(replicates[:, 0], [tail, 100 - tail])
+        lag_low, lag_high = np.percentile(replicates[:, 1], [tail, 100 - tail], method='nearest').astype(int)
+        rows.append([country, period, point[0], corr_low, corr_high, int(point[1]), lag_low, lag_high])
+    columns = ['country', 'period', 'max_corr', 'max_corr_low', 'max_corr_high', 'lag', 'lag_low', 'lag_high']
+    return pd.DataFrame(rows, columns=columns).set_index(['country', 'period'])
+
+
+# (max corr, lag) of the period, and of each of the n_boot replicates (an n_boot x 2 array).
+def _bootstrap_max_correlation(cases, deaths, period, max_lag, n_boot, block_length, batch_size, seed):
+    rng = np.random.default_rng(seed)
+    cases = np.where(period, cases, np.nan)
+    deaths = np.where(period, deaths, np.nan)
+    max_corr, lag = _max_correlation(lagged_correlation(cases, deaths, max_lag)[:, None])
+
+    dates = np.flatnonzero(period)
+    replicates = np.zeros((n_boot, 2))
+    for start in range(0, n_boot, batch_size):
+        batch = min(batch_size, n_boot - start)
+        weights = _block_bootstrap_weights(rng, dates, len(cases), batch, block_length)
+        corrs = lagged_correlation(cases[:, None], deaths[:, None], max_lag, weights=weights)
+        replicates[start:start + batch] = np.column_stack(_max_correlation(corrs))
+    return (max_corr[0], lag[0]), replicates
+
+
+# maximum correlation (NaN taken as 0, as in find_cd_correlations_for_vax_rate) and its lag, for each column.
+def _max_correlation(corrs):
+    corrs = np.nan_to_num(corrs, nan=0)
+    lags = np.argmax(corrs, axis=0)
+    return corrs[lags, np.arange(corrs.shape[1])], lags
+
+
+# (n x batch) weights: how many times each of the dates is drawn by a moving block bootstrap of them.
+def _block_bootstrap_weights(rng, dates, n, batch, block_length):
+    weights = np.zeros((batch, n))
+    if len(dates) == 0:
+        return weights.T
+    block_length = min(block_length, len(dates))
+    n_blocks = -(-len(dates) // block_length)
+    starts = rng.integers(0, len(dates) - block_length + 1, size=(batch, n_blocks))
+    drawn = (starts[:, :, None] + np.arange(block_length)).reshape(batch, -1)[:, :len(dates)]
+    rows = np.repeat(np.arange(batch), len(dates))
+    np.add.at(weights, (rows, dates[drawn].ravel()), 1)
+    return weights.T
+
+
+# For every country: the first date its people_fully_vaccinated_per_hundred is above threshold (at or above
+# with strict = False; NaT when it never is) and its highest total_deaths_per_million.
+# Both come from one groupby pass over each frame (or from the panel when one is given), as a DataFrame
+# indexed by country with a datetime64 'vax_date' and a float64 'total_deaths_per_million' column.
+# country_list: the countries to return, each once (every country of the frames by default).
+def vax_threshold_metrics(df_cd, df_vac, country_list = None, threshold = 0.8, strict = True, panel = None):
+    if panel is not None:
+        vax_dates = td.build_crossing_index(panel, 'people_fully_vaccinated_per_hundred').first_date_at_or_above(threshold, strict)
+        with np.errstate(invalid='ignore'):
+            total_deaths = pd.Series(np.fmax.reduce(panel.values['total_deaths_per_million'], axis=0), index=panel.countries)
+    else:
+        vaccinated = df_vac['people_fully_vaccinated_per_hundred']
+        above = vaccinated > threshold if strict else vaccinated >= threshold
+        vax_dates = pd.to_datetime(df_vac['date'][above]).groupby(df_vac['country'][above], observed=True, sort=False).min()
+        total_deaths = df_cd.groupby('country', observed=True, sort=False)['total_deaths_per_million'].max()
+
+    if country_list is None:
+        country_list = total_deaths.index.union(vax_dates.index, sort=False)
+    country_list = list(dict.fromkeys(country_list))  # one row per country, in the order given
+    metrics = pd.DataFrame({'vax_date': vax_dates.reindex(country_list).astype('datetime64[ns]'),
+                            'total_deaths_per_million': total_deaths.reindex(country_list).astype('float64')})
+    metrics.index = pd.Index(np.asarray(country_list, dtype=object), name='country')
+    return metrics
+
+
+# scatter of the countries' total deaths per million against the date they reached the vaccination threshold
+# (the metrics of vax_threshold_metrics; countries without either value are left out). label: the threshold
+# as shown in the labels and title.
+def draw_vax_vs_total_deaths(ax, metrics, label = '80%'):
+    df_plot = metrics.dropna()
+    ax.scatter(df_plot['vax_date'], df_plot['total_deaths_per_million'], alpha=0.7)
 
+    # Annotate each point with the country name
+    for country, vax_date, total_deaths in zip(df_plot.index, df_plot['vax_date'], df_plot['total_deaths_per_million']):
+        ax.annotate(country, (vax_date, total_deaths), fontsize=9, alpha=0.7)
 
-def vax_vs_total_deaths(df_cd, df_vac, country_list):
-    total_deaths_vax80_date_dict = {}
-    for country in country_list:
-        subset = df_vac[df_vac['country'] == country]
-        vax80_date = subset.loc[subset['people_fully_vaccinated_per_hundred'] > 0.8, 'date'].min()
-    
-        # check country reached 80%
-        if pd.notna(vax80_date):  # Ensure valid date
-            vax80_date = str(vax80_date)  # Convert to string if needed
-        
-        total_deaths_pM = df_cd[df_cd['country'] == country]['total_deaths_per_million'].max(skipna=True)
-    
-        total_deaths_vax80_date_dict[country] = [vax80_date, total_deaths_pM]  
+    # Labels and title
+    ax.set_xlabel(f"Date of {label} Vaccination")
+    ax.set_ylabel("Total Deaths per Million")
+    ax.set_title(f"Total Deaths per Million vs. Date of {label} Vaccination")
+    ax.tick_params(axis='x', labelrotation=45)
+    ax.grid(True)
+
+
+# the scatter of draw_vax_vs_total_deaths drawn off screen (no pyplot figure, nothing shown) and written to output_file.
+def save_vax_vs_total_deaths(metrics, output_file = 'cd_vax.png', label = '80%'):
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    fig = Figure(figsize=(12, 6))
+    FigureCanvasAgg(fig)
+    draw_vax_vs_total_deaths(fig.add_subplot(), metrics, label)
+    fig.savefig(output_file)
+    return output_file
+
+
+# panel: a td.CovidPanel of df_cd and df_vac, read instead of the frames when given.
+def vax_vs_total_deaths(df_cd, df_vac, country_list, panel = None):
+    import matplotlib.pyplot as plt
+
+    metrics = vax_threshold_metrics(df_cd, df_vac, country_list, panel=panel)
 
     # Plotting
     #--------------------------
-    df_plot = pd.DataFrame.from_dict(total_deaths_vax80_date_dict, orient='index', columns=['vax80_date', 'total_deaths_per_million'])
-    
-    # Drop rows where vax80_date is NaN
-    df_plot = df_plot.dropna()
-    
-    # Convert dates to datetime format
-    df_plot['vax80_date'] = pd.to_datetime(df_plot['vax80_date'])
-    
-    # Plot scatter plot
-    plt.figure(figsize=(12, 6))
-    plt.scatter(df_plot['vax80_date'], df_plot['total_deaths_per_million'], alpha=0.7)
-    
-    # Annotate each point with the country name
-    for country, row in df_plot.iterrows():
-        plt.annotate(country, (row['vax80_date'], row['total_deaths_per_million']), fontsize=9, alpha=0.7)
-    
-    # Labels and title
-    plt.xlabel("Date of 80% Vaccination")
-    plt.ylabel("Total Deaths per Million")
-    plt.title("Total Deaths per Million vs. Date of 80% Vaccination")
-    plt.xticks(rotation=45)
-    plt.grid(True)
-
-    plt.savefig('cd_vax.png')
+    fig, ax = plt.subplots(figsize=(12, 6))
+    draw_vax_vs_total_deaths(ax, metrics)
+    fig.savefig('cd_vax.png')
     plt.show()
+    return metrics
 
 
 
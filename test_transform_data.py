@@ -0,0 +1,178 @@
+import warnings
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import transform_data as td
+from benchmark import make_synthetic_tables, reference_process_covid_data, rows_on
+
+
+# Parity checks of the optimised pipeline against the original code, on small synthetic tables shaped like
+# the OWID covid tables (make_synthetic_tables). Run with python -m pytest; benchmark.py times the same code.
+#--------------------------------
+
+@pytest.fixture(scope='module')
+def tables():
+    return make_synthetic_tables(n_countries=12, n_days=400, seed=1)
+
+
+# the grouped cleaning engine (and each correction run on its own) gives exactly the output of the original loops.
+def test_cleaning_parity(tables):
+    tb_country_cases_deaths, tb_country_vac = tables
+    df_cd_loop, df_vac_loop = reference_process_covid_data(tb_country_cases_deaths, tb_country_vac)
+    df_cd_fast, df_vac_fast = td.process_covid_data(tb_country_cases_deaths, tb_country_vac)
+    pd.testing.assert_frame_equal(df_cd_fast, df_cd_loop, check_exact=True)
+    pd.testing.assert_frame_equal(df_vac_fast, df_vac_loop, check_exact=True)
+
+    df_cd = td.basic_processing(tb_country_cases_deaths, td.features_cd)
+    blocks = td.country_blocks(df_cd)
+    df_cd = td.correct_anomalous_spike(td.correct_weekly_reporting_in_daily(df_cd, blocks), blocks)
+    pd.testing.assert_frame_equal(df_cd, df_cd_loop, check_exact=True)
+
+
+# daily incremental updates give exactly the output of a full recompute, starting from the first
+# n_initial_days (short histories whose body isn't settled yet) and from all but the last n_update_days.
+@pytest.mark.parametrize('n_initial_days, n_update_days', [(12, 30), (370, 30)])
+def test_incremental_parity(tables, n_initial_days, n_update_days):
+    tb_country_cases_deaths, tb_country_vac = tables
+    dates = tb_country_cases_deaths.index.get_level_values('date').unique().sort_values()[:n_initial_days + n_update_days]
+    tb_cd, tb_vac = rows_on(tb_country_cases_deaths, dates), rows_on(tb_country_vac, dates)
+    state = td.IncrementalCovidData(rows_on(tb_cd, dates[:n_initial_days]), rows_on(tb_vac, dates[:n_initial_days]))
+    for date in dates[n_initial_days:]:
+        state.update(rows_on(tb_cd, [date]), rows_on(tb_vac, [date]))
+    df_cd, df_vac = td.process_covid_data(tb_cd, tb_vac)
+    pd.testing.assert_frame_equal(state.df_cd, df_cd, check_exact=True)
+    pd.testing.assert_frame_equal(state.df_vac, df_vac, check_exact=True)
+
+
+# processing the tables written as CSV exports, read chunksize rows at a time, gives exactly the output of
+# process_covid_data.
+def test_streaming_parity(tables, tmp_path, chunksize = 500):
+    paths = [tmp_path / 'cases_deaths.csv', tmp_path / 'vac.csv']
+    for tb, path in zip(tables, paths):
+        tb.reset_index().to_csv(path, index=False, float_format='%.17g')
+
+    df_cd, df_vac = td.process_covid_data(*tables)
+    stream_cd, stream_vac = td.process_covid_csv(*paths, chunksize=chunksize)
+    pd.testing.assert_frame_equal(stream_cd, df_cd, check_exact=True)
+    pd.testing.assert_frame_equal(stream_vac, df_vac, check_exact=True)
+
+
+# Correlations
+#--------------------------------
+
+# find_cd_correlations_for_vax_rate as first written: each country's periods sliced by date, and one
+# Series.shift(lag).corr per lag and period.
+def reference_find_cd_correlations_for_vax_rate(df_cd, df_vac, v_low, v_high, max_lag, country_list, panel = None):
+    max_lagged_corr = {}
+    if panel is None:
+        panel = td.build_panel(df_cd, df_vac)
+    
+    for country in country_list:
+        vac_series = panel.series('people_fully_vaccinated_per_hundred', country)
+        vax_low_date = vac_series.index[vac_series <= v_low].max()
+        vax_high_date = vac_series.index[vac_series >= v_high].min()
+        
+        # Convert base country's 'feature' (e.g., cases) into a time series
+        cases_series = panel.series('new_cases', country)
+        deaths_series = panel.series('new_deaths', country)
+        
+        # Define the date range
+        first_date = cases_series.index.min()  # Earliest date in the dataset
+        last_date = cases_series.index.max()
+        
+        # Restrict data to the period before and after vax_low_date
+        cases_series_vlow = cases_series.loc[first_date:vax_low_date]
+        deaths_series_vlow = deaths_series.loc[first_date:vax_low_date]
+        
+        cases_series_vhigh = cases_series.loc[vax_high_date:last_date]
+        deaths_series_vhigh = deaths_series.loc[vax_high_date:last_date]
+        
+        lagged_corrs_vlow = {}
+        lagged_corrs_vhigh = {}
+        # Loop through lags and calculate correlations
+        for lag in range(0, max_lag + 1):
+            shifted_cases_series_vlow = cases_series_vlow.shift(lag)
+            shifted_cases_series_vhigh = cases_series_vhigh.shift(lag)
+        
+            # Normalized correlation
+            corr_value_vlow = shifted_cases_series_vlow.corr(deaths_series_vlow)
+            corr_value_vhigh = shifted_cases_series_vhigh.corr(deaths_series_vhigh)
+    
+            # Handle NaN values
+            lagged_corrs_vlow[lag] = 0 if pd.isna(corr_value_vlow) else corr_value_vlow
+            lagged_corrs_vhigh[lag] = 0 if pd.isna(corr_value_vhigh) else corr_value_vhigh
+        
+        # Find the max correlation and corresponding lag
+        max_lag_index_vlow = max(lagged_corrs_vlow, key=lagged_corrs_vlow.get)
+        max_corr_value_vlow = lagged_corrs_vlow[max_lag_index_vlow]
+        max_lag_index_vhigh = max(lagged_corrs_vhigh, key=lagged_corrs_vhigh.get)
+        max_corr_value_vhigh = lagged_corrs_vhigh[max_lag_index_vhigh]
+    
+        # record maximum lags for each country
+        max_lagged_corr[country] = [max_lag_index_vlow, max_corr_value_vlow, max_lag_index_vhigh, max_corr_value_vhigh]
+    return max_lagged_corr
+
+
+# find_cd_correlations_for_vax_rate gives the lags of the original loop exactly and its correlations within
+# 1e-9, on the processed tables with NaN gaps in the cases and deaths, for thresholds crossed by the countries
+# and thresholds never crossed (every date in the low period, an empty high period).
+@pytest.mark.parametrize('v_low, v_high', [(0.1, 0.9), (20, 60), (-1, 1000)])
+def test_correlation_parity(tables, v_low, v_high, max_lag = 60, seed = 0):
+    import statistical_analysis as sa
+
+    rng = np.random.default_rng(seed)
+    df_cd, df_vac = td.process_covid_data(*tables)
+    for col in ['new_cases', 'new_deaths']:
+        values = df_cd[col].to_numpy(copy=True)
+        values[rng.random(len(values)) < 0.05] = np.nan  # scattered missing days
+        start = rng.integers(0, len(values) - 30)
+        values[start:start + 30] = np.nan  # a missing month
+        df_cd[col] = values
+    panel = td.build_panel(df_cd, df_vac)
+    country_list = list(panel.countries)
+
+    fast = sa.find_cd_correlations_for_vax_rate(df_cd, df_vac, v_low, v_high, max_lag, country_list, panel=panel)
+    with warnings.catch_warnings():  # constant or too short periods: NaN correlations, set to 0
+        warnings.simplefilter('ignore', RuntimeWarning)
+        loop = reference_find_cd_correlations_for_vax_rate(df_cd, df_vac, v_low, v_high, max_lag, country_list, panel=panel)
+    for country in country_list:
+        lag_low, corr_low, lag_high, corr_high = fast[country]
+        assert (lag_low, lag_high) == (loop[country][0], loop[country][2]), \
+            f"lags of {country} differ from the original loop: {fast[country]} vs {loop[country]}"
+        assert abs(corr_low - loop[country][1]) <= 1e-9 and abs(corr_high - loop[country][3]) <= 1e-9, \
+            f"correlations of {country} differ from the original loop: {fast[country]} vs {loop[country]}"
+
+
+# Country charts
+#--------------------------------
+
+# the batch renderer draws, pixel for pixel, the charts of plot_country_cd / plot_country_vac, rendering in
+# turn countries with data and countries with none (no data at all, or no daily vaccinations), so each chart
+# follows one whose axes were scaled to other data.
+@pytest.mark.parametrize('kind', ['cd', 'vac'])
+def test_country_chart_parity(tables, tmp_path, monkeypatch, kind, n_countries = 4):
+    matplotlib = pytest.importorskip('matplotlib')
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    import plot_data as pl
+
+    df_cd, df_vac = td.process_covid_data(*tables)
+    countries = list(df_cd['country'].unique()[:n_countries])
+    no_data, no_daily_vac = countries[1], countries[2]
+    df_cd.loc[df_cd['country'] == no_data, ['new_cases', 'new_deaths']] = np.nan
+    df_vac.loc[df_vac['country'] == no_data, td.features_vac] = np.nan
+    df_vac.loc[df_vac['country'] == no_daily_vac, 'daily_people_vaccinated_smoothed_per_hundred'] = np.nan
+    panel = td.build_panel(df_cd, df_vac)
+    df, plot = (df_cd, pl.plot_country_cd) if kind == 'cd' else (df_vac, pl.plot_country_vac)
+
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'batch').mkdir()
+    renderer = pl.CountryChartRenderer(kind, panel)
+    for country in countries + [no_data, countries[0]]:
+        plot(country, df, panel=panel)
+        plt.close('all')
+        path = renderer.render(country, 'batch')
+        assert np.array_equal(plt.imread(path), plt.imread(pl.chart_file(kind, country))), \
+            f"batch {kind} chart of {country} differs from the one of plot_country_{kind}"
@@ -1,165 +1,932 @@
+import time
+import tracemalloc
+from contextlib import nullcontext
+
 import pandas as pd
 import numpy as np
 
+# features kept from the cases and deaths, and vaccination tables.
+features_cd = ["new_cases", "new_deaths", "total_deaths_per_million"]
+features_vac = ["daily_people_vaccinated_smoothed_per_hundred", 
+        "people_fully_vaccinated_per_hundred", 
+        "total_boosters_per_hundred"]
+
 # process data into a useable form.
 def basic_processing(tb, features, correct_a_nz = False):
     
-    # Select certain features, convert the indexes into rows, ffill the NAs
-    df = tb[features].reset_index().ffill()
+    with _stage('basic_processing', ', '.join(features)) as stage:
+        # Select certain features, convert the indexes into rows, ffill the NAs
+        df = tb[features].reset_index().ffill()
     
-    # Remove rows where 'country' is in the list 'non_countries'
-    df = df[~df['country'].isin(non_countries)]
+        # Remove rows where 'country' is in the list 'non_countries'
+        df = df[~df['country'].isin(non_countries)]
+        if stage is not None:
+            stage.rows, stage.rows_modified = len(tb), len(tb) - len(df)  # rows modified: the non-countries removed
 
     # Return each feature's DataFrame as a separate variable
     return df
 
 
 # pre-process cases, deaths and vaccination data
-def process_covid_data(tb_country_cases_deaths, tb_country_vac):
+# compact = True returns the frames in the compact layout of compact_frames.
+def process_covid_data(tb_country_cases_deaths, tb_country_vac, compact = False):
 
     # Cases and deaths data.
     #--------------------------------
-    features_cd = ["new_cases", "new_deaths", "total_deaths_per_million"]
     df_cd = basic_processing(tb_country_cases_deaths, features_cd)
-    df_cd = correct_weekly_reporting_in_daily(df_cd)  # correct weekly reporting in the daily column.
-    df_cd = correct_anomalous_spike(df_cd) # remove anomalous spike
+    df_cd = correct_cases_deaths_by_country(df_cd)  # correct weekly reporting in the daily column and remove anomalous spikes.
     
     # Vaccination data.
     #--------------------------------
-    features_vac = ["daily_people_vaccinated_smoothed_per_hundred", 
-            "people_fully_vaccinated_per_hundred", 
-            "total_boosters_per_hundred"]
     df_vac = basic_processing(tb_country_vac, features_vac, True)
     df_vac = correct_anomalous_nonzeros(df_vac) # correct the anomalous-zero error in the vaccination data
 
+    if compact:
+        df_cd, df_vac = compact_frames(df_cd, df_vac)
+
     # return processed data.
     return df_cd, df_vac 
 
-def correct_anomalous_spike(df):
-    # Get list of unique countries
-    country_list = df['country'].unique()
-    
-    for country in country_list:
-        # Select rows corresponding to the current country
-        df_country = df[df['country'] == country].copy()  # Avoid modifying a slice of df
-
-        # Correct 'people_fully_vaccinated_per_hundred'
-        df_cases = df_country['new_cases']
-        df_deaths = df_country['new_deaths']
-
-        # Get the 10 largest values and calculate their mean
-        top_10_cases_mean = round(df_cases.nlargest(10).mean())
-        top_10_deaths_mean = round(df_deaths.nlargest(10).mean())
-
-        # Identify values that are more than 10 times the mean of the top 10 largest values
-        scalar = 5
-        high_cases = df_cases > scalar * top_10_cases_mean
-        high_deaths = df_deaths > scalar * top_10_deaths_mean
-
-        # Correct the values by setting them to the mean of the top 10 largest values
-        df_country.loc[high_cases, 'new_cases'] = top_10_cases_mean
-        df_country.loc[high_deaths, 'new_deaths'] = top_10_deaths_mean
-
-        # Reassign the corrected values back to the original dataframe
-        df.loc[df['country'] == country, 'new_cases'] = df_country['new_cases']
-        df.loc[df['country'] == country, 'new_deaths'] = df_country['new_deaths']
-
-    return df
+# anomalous spike: a value more than 5 times the (rounded) mean of the country's 10 largest values is set to that mean.
+# blocks: optional country_blocks(df), when the caller already has them.
+def correct_anomalous_spike(df, blocks = None):
+    countries, starts, stops = country_blocks(df) if blocks is None else blocks
+    return _correct_columns(df, ['new_cases', 'new_deaths'], lambda values, col:
+                            _correct_blocks('anomalous_spike', _anomalous_spike_kernel, values, col, starts, stops))
     
 
 # anomalous non-zeros: when the vaccinations or boosters have periods of non-zero values before any vaccines were administered.
-def correct_anomalous_nonzeros(df):
-    # Get list of unique countries
-    country_list = df['country'].unique()
-    
-    for country in country_list:
-        # Select rows corresponding to the current country
-        df_vac_country = df[df['country'] == country].copy()  # Avoid modifying a slice of df
-
-        # Correct 'people_fully_vaccinated_per_hundred'
-        df_vac_p100 = df_vac_country['people_fully_vaccinated_per_hundred']
-        decreasing_mask_vac = df_vac_p100 < df_vac_p100.cummax()
-        if decreasing_mask_vac.any(): 
-        
-            # Get the two indices between which values will be set to zero
-            first_decrease_index_vac = decreasing_mask_vac.idxmax()
-            first_country_ind = df.loc[df['country'] == country].index[0]  # Get first index for country
-        
-            # Set 'people_fully_vaccinated_per_hundred' to 0 for indices from first_country_ind to first_decrease_index_vac
-            df.loc[(first_country_ind <= df.index) & (df.index < first_decrease_index_vac), 'people_fully_vaccinated_per_hundred'] = 0
-
-
-        # Correct 'total_boosters_per_hundred'
-        df_boosters_p100 = df_vac_country['total_boosters_per_hundred']
-        decreasing_mask_boost = df_boosters_p100 < df_boosters_p100.cummax()
-        if decreasing_mask_boost.any(): 
-
-            # get the two index between which values will be set to zero.
-            first_decrease_index_boost = decreasing_mask_boost.idxmax()
-            first_country_ind = df.loc[df['country'] == country].index[0]  # Get first index for 'India'
-
-            # Set 'total_boosters_per_hundred' to 0 for indices from ind to ind + 99
-            df.loc[(first_country_ind <= df.index) & (df.index < first_decrease_index_boost), 'total_boosters_per_hundred'] = 0
-
-    return df
+def correct_anomalous_nonzeros(df, blocks = None):
+    countries, starts, stops = country_blocks(df) if blocks is None else blocks
+    return _correct_columns(df, ['people_fully_vaccinated_per_hundred', 'total_boosters_per_hundred'], lambda values, col:
+                            _correct_blocks('anomalous_nonzeros', _anomalous_nonzeros_kernel, values, col, starts, stops))
 
 
 # Sometimes countries will post the cumulative days data on one day of the week.
 # mean method in use.
-def correct_weekly_reporting_in_daily(df):
-    # Get list of unique countries
-    country_list = df['country'].unique()
-
-    # Go through country list
-    for country in country_list:
-        df_country = df[df['country'] == country].copy()
-        
-        # Cases and deaths data
-        df_country_cases = df_country['new_cases']
-        df_country_deaths = df_country['new_deaths']
-        
-        # Create a boolean mask for six consecutive zeros followed by a non-zero value for 'new_cases'
-        mask_cases = (df_country_cases.shift(1) == 0) & (df_country_cases.shift(2) == 0) & (df_country_cases.shift(3) == 0) & \
-                     (df_country_cases.shift(4) == 0) & (df_country_cases.shift(5) == 0) & \
-                     (df_country_cases.shift(6) == 0) & (df_country_cases != 0)
-        
-        # Create a boolean mask for six consecutive zeros followed by a non-zero value for 'new_deaths'
-        mask_deaths = (df_country_deaths.shift(1) == 0) & (df_country_deaths.shift(2) == 0) & (df_country_deaths.shift(3) == 0) & \
-                      (df_country_deaths.shift(4) == 0) & (df_country_deaths.shift(5) == 0) & \
-                      (df_country_deaths.shift(6) == 0) & (df_country_deaths != 0)
-
-        
-        # Get the indices where the pattern matches for cases and deaths
-        indices_cases = mask_cases.index[mask_cases].tolist() - df_country_cases.index[0]
-        indices_deaths = mask_deaths.index[mask_deaths].tolist() - df_country_deaths.index[0]
-
-        # cases
-        # For each index in cases, modify the `new_cases` values in the range j to j+5
-        new_cases_col = df_country_cases.copy()
-        for j in indices_cases:
-            if j + 6 < len(df_country_cases):  # Ensure j+6 is within bounds
-                new_cases_col.iloc[j:j+6] = round(np.mean(df_country_cases.iloc[j:j+6]))
-        
-        # Now assign the new_cases_col to the original DataFrame
-        df.loc[(df['country'] == country), 'new_cases'] = new_cases_col
-
-        
-        # deaths
-        # For each index in deaths, modify the `new_deaths` values in the range j to j+5
-        new_deaths_col = df_country_deaths.copy()
-        for j in indices_deaths:
-            if j + 6 < len(df_country_deaths):  # Ensure j+6 is within bounds
-                new_deaths_col.iloc[j:j+6] = round(np.mean(df_country_deaths.iloc[j:j+6]))
-
-        # Now assign the new_deaths_col to the original DataFrame
-        df.loc[(df['country'] == country), 'new_deaths'] = new_deaths_col
-
+def correct_weekly_reporting_in_daily(df, blocks = None):
+    countries, starts, stops = country_blocks(df) if blocks is None else blocks
+    return _correct_columns(df, ['new_cases', 'new_deaths'], lambda values, col:
+                            _correct_weekly_reporting(values, col, starts, stops))
+
+
+# Grouped cleaning engine
+#--------------------------------
+# The processed tables keep each country's rows together (the OWID tables are indexed by country, date),
+# so every country is a contiguous block of rows, found once as an offset table (country_blocks).
+# The corrections copy the columns they change one at a time, correct each block in place through a
+# view of the copy and write the column back into the frame (in place, as the original loops did, so the
+# frame they are given is the one they return): no per-country masks, slices or write-backs, and at most
+# one copy of one column at a time.
+
+# start and stop row positions of each country's block of rows (found by comparing each row's country with
+# the previous one, without factorizing the whole column).
+def country_blocks(df):
+    country = df['country'].array
+    change = np.flatnonzero(np.asarray(country[1:] != country[:-1], dtype=bool)) + 1
+    starts = np.concatenate(([0], change))
+    stops = np.concatenate((change, [len(country)]))
+    if len(country) == 0:
+        starts, stops = starts[:0], stops[:0]
+    countries = np.asarray(country.take(starts), dtype=object)
+    if not pd.Index(countries).is_unique:
+        raise ValueError("rows of each country must be contiguous")
+    return countries, starts, stops
+
+
+# each of cols copied to float64, corrected in place by correct(values, col) and written back into df in
+# turn, so only one column is copied at a time; returns df.
+def _correct_columns(df, cols, correct):
+    for col in cols:
+        values = df[col].to_numpy(dtype='float64', na_value=np.nan, copy=True)
+        correct(values, col)
+        if df[col].dtype == values.dtype:
+            df.loc[:, col] = values  # into the frame's own column, unless it shares it (copy on write)
+        else:
+            df[col] = pd.Series(values, index=df.index).astype(df[col].dtype)
+        del values  # before the next column is copied
     return df
 
 
-
-
-    
+# weekly reporting fix for one country (same rule as correct_weekly_reporting_in_daily), in place.
+def _weekly_reporting_kernel(x):
+    return _weekly_reporting_blocks(x, np.array([0]), np.array([len(x)]))
+
+
+# weekly reporting fix of every block x[starts[b]:stops[b]] of a contiguous array (blocks in order), in place.
+# A block is one country's column, so with the columns of a table laid end to end a single call corrects
+# all of them. A match is six zeros followed by a non-zero value at j, all in the same block, with j+6
+# before the end of the block; rows j to j+5 take the rounded mean of their values (NaNs skipped, summed
+# in the same order as pandas). The row after six zeros is non-zero, so the next match is at least 7 rows
+# later and the windows never overlap: each mean is taken over values no other window changed.
+def _weekly_reporting_blocks_numpy(x, starts, stops):
+    if len(x) <= 6:
+        return x
+
+    # six zeros followed by a non-zero value, found by and-ing the shifted zero masks (one byte per row each).
+    zero = x == 0
+    match = x[6:] != 0
+    for k in range(6):
+        match &= zero[k:len(x) - 6 + k]
+    j = np.flatnonzero(match) + 6
+    block = np.searchsorted(starts, j, side='right') - 1
+    j = j[(j - 6 >= starts[block]) & (j + 6 < stops[block])]  # Ensure j+6 is within bounds
+    if len(j) == 0:
+        return x
+
+    rows = j[:, None] + np.arange(6)
+    window = x[rows]
+    count = (~np.isnan(window)).sum(axis=1)
+    total = np.zeros(len(j))
+    for k in range(6):
+        total += np.nan_to_num(window[:, k])
+    with np.errstate(invalid='ignore'):
+        means = np.round(total / count)
+    x[rows] = means[:, None]
+    return x
+
+
+# the same fix as one loop over the rows, compiled with numba when it is installed.
+def _weekly_reporting_blocks_loop(x, starts, stops):
+    for b in range(len(starts)):
+        stop = stops[b]
+        zeros = 0
+        j = starts[b]
+        while j < stop:
+            if x[j] == 0:
+                zeros += 1
+            elif zeros >= 6 and j + 6 < stop:
+                total = 0.0
+                count = 0
+                for k in range(j, j + 6):
+                    if not np.isnan(x[k]):
+                        total += x[k]
+                        count += 1
+                mean = np.rint(total / count) if count > 0 else np.nan
+
+                # the zero run restarts at j and goes on over the original values of the window.
+                zeros = 0
+                for k in range(j + 1, j + 6):
+                    zeros = zeros + 1 if x[k] == 0 else 0
+                for k in range(j, j + 6):
+                    x[k] = mean
+                j += 6
+                continue
+            else:
+                zeros = 0
+            j += 1
+    return x
+
+
+# numba, imported on first use so that importing transform_data stays light (None when it isn't installed,
+# and the weekly reporting fix then runs the NumPy version of its kernel).
+def _numba():
+    try:
+        import numba
+    except ImportError:
+        return None
+    return numba
+
+
+_weekly_reporting_impl = None
+
+
+# the weekly reporting fix of the blocks, with the kernel chosen (and compiled by numba) on the first call.
+def _weekly_reporting_blocks(x, starts, stops):
+    global _weekly_reporting_impl
+    if _weekly_reporting_impl is None:
+        numba = _numba()
+        _weekly_reporting_impl = numba.njit(cache=True)(_weekly_reporting_blocks_loop) if numba is not None \
+            else _weekly_reporting_blocks_numpy
+    return _weekly_reporting_impl(x, starts, stops)
+
+
+# anomalous spike fix for one country (same rule as correct_anomalous_spike), in place.
+def _anomalous_spike_kernel(x, scalar = 5):
+    return _apply_spike(x, _top_10_mean(_top_10(x)), scalar)
+
+
+# the 10 largest non-NaN values, in the descending order nlargest would return them.
+def _top_10(x):
+    values = x[~np.isnan(x)]
+    return np.ascontiguousarray(np.sort(values)[::-1][:10])
+
+
+# rounded mean of the top 10 (NaN when there are no values).
+def _top_10_mean(top_10):
+    if len(top_10) == 0:
+        return np.nan
+    return np.round(top_10.sum() / len(top_10))
+
+
+def _apply_spike(x, top_10_mean, scalar = 5):
+    if not np.isnan(top_10_mean):
+        x[x > scalar * top_10_mean] = top_10_mean
+    return x
+
+
+# anomalous non-zeros fix for one country (same rule as correct_anomalous_nonzeros), in place.
+def _anomalous_nonzeros_kernel(x):
+    decreasing = x < np.fmax.accumulate(x)
+    if decreasing.any():
+        x[:np.argmax(decreasing)] = 0
+    return x
+
+
+# weekly reporting and anomalous spike corrections for the cases and deaths, one column at a time: the
+# weekly fix in one pass over the column's blocks, then the spike fix per country.
+def correct_cases_deaths_by_country(df, blocks = None):
+    countries, starts, stops = country_blocks(df) if blocks is None else blocks
+
+    def correct(values, col):
+        _correct_weekly_reporting(values, col, starts, stops)
+        _correct_blocks('anomalous_spike', _anomalous_spike_kernel, values, col, starts, stops)
+
+    return _correct_columns(df, ['new_cases', 'new_deaths'], correct)
+
+
+# weekly reporting fix of a column, in place, in one call over all its blocks.
+def _correct_weekly_reporting(values, col, starts, stops):
+    with _stage('weekly_reporting', col, values):
+        _weekly_reporting_blocks(values, starts, stops)
+
+
+# a correction applied to every country block of a column, in place.
+def _correct_blocks(stage, kernel, values, col, starts, stops):
+    with _stage(stage, col, values):
+        for start, stop in zip(starts, stops):
+            kernel(values[start:stop])  # view, corrected in place
+
+
+# Stage profiling
+#--------------------------------
+# Inside a StageProfiler block, every stage of the processing (basic_processing, and each correction per
+# feature) records its wall time, the rows it went through, the rows it modified and, with memory = True,
+# the peak memory it allocated (measured with tracemalloc, which slows everything down while it runs).
+# Records go to report() and, one by one, to callback(record). Outside a StageProfiler block the stages are
+# a shared no-op context, and no copies or counts are made.
+#
+#   with td.StageProfiler() as profiler:
+#       df_cd, df_vac = td.process_covid_data(tb_country_cases_deaths, tb_country_vac)
+#   profiler.report()
+
+_profiler = None  # the active StageProfiler
+_no_stage = nullcontext()
+
+
+class StageProfiler:
+
+    def __init__(self, callback = None, memory = False):
+        self.callback = callback
+        self.memory = memory
+        self.records = []
+
+    def __enter__(self):
+        global _profiler
+        self._previous = _profiler
+        _profiler = self
+        self._stop_tracing = self.memory and not tracemalloc.is_tracing()
+        if self._stop_tracing:
+            tracemalloc.start()
+        return self
+
+    def __exit__(self, *exc):
+        global _profiler
+        _profiler = self._previous
+        if self._stop_tracing:
+            tracemalloc.stop()
+
+    def add(self, record):
+        self.records.append(record)
+        if self.callback is not None:
+            self.callback(record)
+
+    # one row per stage: stage, feature, seconds, rows, rows_modified and peak_mb (NaN without memory).
+    def report(self):
+        return pd.DataFrame(self.records, columns=['stage', 'feature', 'seconds', 'rows', 'rows_modified', 'peak_mb'])
+
+
+# one stage of a StageProfiler. values: the array the stage corrects in place, compared with a copy taken
+# before the stage to count the rows it modified (otherwise the stage sets rows and rows_modified itself).
+class _Stage:
+
+    def __init__(self, profiler, name, feature, values = None):
+        self.profiler = profiler
+        self.name = name
+        self.feature = feature
+        self.values = values
+        self.rows = len(values.reshape(-1)) if values is not None else 0
+        self.rows_modified = 0
+
+    def __enter__(self):
+        self.before = self.values.copy() if self.values is not None else None
+        if self.profiler.memory:
+            tracemalloc.reset_peak()
+            self.memory_start = tracemalloc.get_traced_memory()[0]
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = time.perf_counter() - self.start
+        peak_mb = np.nan
+        if self.profiler.memory:
+            peak_mb = (tracemalloc.get_traced_memory()[1] - self.memory_start) / 1e6
+        if self.before is not None:
+            unchanged = (self.before == self.values) | (np.isnan(self.before) & np.isnan(self.values))
+            self.rows_modified = int((~unchanged).sum())
+        self.profiler.add({'stage': self.name, 'feature': self.feature, 'seconds': seconds, 'rows': self.rows,
+                           'rows_modified': self.rows_modified, 'peak_mb': peak_mb})
+
+
+# the stage as a context (a _Stage when profiling, yielding None otherwise).
+def _stage(name, feature, values = None):
+    if _profiler is None:
+        return _no_stage
+    return _Stage(_profiler, name, feature, values)
+
+
+# Streaming ingestion of CSV exports
+#--------------------------------
+# The OWID CSV exports (columns country, date and the features, the rows of each country together, as in
+# the catalog tables) are read chunksize rows at a time and processed one country at a time, so memory is
+# bounded by a chunk and the largest country rather than the whole table. The forward fill carries the last
+# value of each feature from one chunk to the next, and the non-countries are dropped after the fill, so the
+# frames are exactly those of basic_processing (and the corrected ones those of process_covid_data).
+
+# basic_processing on a CSV export: one forward-filled DataFrame per country, in file order.
+def read_owid_csv(path, features, chunksize = 100000):
+    carry = pd.Series(np.nan, index=features)  # last filled values of the previous chunk
+    current, pending = None, []  # the country being read and its rows so far
+    done = set()
+    offset = 0
+    for chunk in pd.read_csv(path, usecols=['country', 'date'] + features, dtype={col: 'float64' for col in features},
+                             parse_dates=['date'], float_precision='round_trip', chunksize=chunksize):
+        chunk = chunk[['country', 'date'] + features]
+        chunk.index = pd.RangeIndex(offset, offset + len(chunk))  # row numbers of the full table
+        offset += len(chunk)
+        chunk[features] = chunk[features].ffill().fillna(carry)
+        carry = chunk[features].iloc[-1]
+
+        countries, starts, stops = country_blocks(chunk)
+        for country, start, stop in zip(countries, starts, stops):
+            if country != current:
+                if pending:
+                    yield pd.concat(pending)
+                if country in done:
+                    raise ValueError(f"rows of '{country}' must be contiguous in {path}")
+                done.add(country)
+                current, pending = country, []
+            if country not in non_countries:
+                pending.append(chunk.iloc[start:stop])
+    if pending:
+        yield pd.concat(pending)
+
+
+# process_covid_data on one CSV export (kind 'cd' for cases and deaths, 'vac' for vaccinations): the
+# corrected frame of each country, in file order.
+def stream_covid_data(path, kind, chunksize = 100000):
+    features, correct = (features_cd, correct_cases_deaths_by_country) if kind == 'cd' else \
+        (features_vac, correct_anomalous_nonzeros)
+    for df in read_owid_csv(path, features, chunksize):
+        yield correct(df)
+
+
+# process_covid_data on the CSV exports of the two tables, read in chunks.
+def process_covid_csv(path_cases_deaths, path_vac, chunksize = 100000, compact = False):
+    df_cd = pd.concat(stream_covid_data(path_cases_deaths, 'cd', chunksize))
+    df_vac = pd.concat(stream_covid_data(path_vac, 'vac', chunksize))
+    if compact:
+        df_cd, df_vac = compact_frames(df_cd, df_vac)
+    return df_cd, df_vac
+
+
+# Incremental daily update
+#--------------------------------
+# OWID adds one row per country each day. IncrementalCovidData keeps what the corrections need between
+# updates, as flat arrays over the countries' rows (the processed frames' columns) and small arrays with one
+# value per block of rows, so an update inserts the new rows and rewrites only the rows each correction can
+# affect, for all the countries at once:
+#  - forward fill: the new rows, plus the leading NaNs of a following country that take their value
+#    (the fill runs over the whole table, so a country's leading NaNs hold the carried last value of the
+#    blocks before it),
+#  - weekly reporting: the last 6 rows (a window starting up to 6 rows before the old end can now
+#    be complete), using the last 17 rows as context, and the first lead + 11 rows when the leading NaNs change,
+#  - anomalous spike: the same rows, and the whole country only when its top-10 mean changes,
+#  - anomalous non-zeros: the running maximum and first decrease of the rows after the leading NaNs are
+#    kept, so new rows are compared with the running maximum, and a new carried value with the first value
+#    after the leading NaNs (the leading NaNs all hold the carried value: the first decrease is the first row
+#    after them when that row is below it, and otherwise the first decrease of the rows after them).
+# A country whose leading NaNs grow, or whose rows are still too few for the body of the spike correction,
+# is recomputed in full. df_cd and df_vac are always identical to process_covid_data on the full tables.
+class IncrementalCovidData:
+
+    def __init__(self, tb_country_cases_deaths, tb_country_vac):
+        self.cd = _IncrementalTable(tb_country_cases_deaths, features_cd, 'cd')
+        self.vac = _IncrementalTable(tb_country_vac, features_vac, 'vac')
+        self.df_cd = self.cd.frame()
+        self.df_vac = self.vac.frame()
+
+    # add the new raw rows (tables indexed by country, date, like the OWID tables) and return the updated frames.
+    # Every new row must be dated after the last row of its country, and new countries need a full recompute.
+    def update(self, new_tb_country_cases_deaths, new_tb_country_vac):
+        if new_tb_country_cases_deaths is not None:
+            self.cd.update(new_tb_country_cases_deaths)
+            self.df_cd = self.cd.frame()
+        if new_tb_country_vac is not None:
+            self.vac.update(new_tb_country_vac)
+            self.df_vac = self.vac.frame()
+        return self.df_cd, self.df_vac
+
+
+# one table's state. Blocks are the countries' and non-countries' rows, in table order (the non-countries'
+# values are carried into the next country by the forward fill); the flat arrays hold the countries' rows
+# only, and the per-country arrays have one value per kept block.
+class _IncrementalTable:
+
+    def __init__(self, tb, features, kind):
+        raw = tb[features].reset_index()
+        self.features = features
+        self.kind = kind
+        self.dtypes = raw.dtypes
+        self.corrected_features = ['new_cases', 'new_deaths'] if kind == 'cd' else \
+            ['people_fully_vaccinated_per_hundred', 'total_boosters_per_hundred']
+
+        countries, starts, stops = country_blocks(raw)
+        self.countries = list(countries)
+        self.kept = np.flatnonzero(~np.isin(countries, non_countries))
+        self.kept_index = np.full(len(countries), -1)
+        self.kept_index[self.kept] = np.arange(len(self.kept))
+        self.lengths = stops - starts
+        dates = raw['date'].to_numpy()
+        self.last_dates = dates[stops - 1]
+        rows = _ranges(starts[self.kept], stops[self.kept])
+        self.dates = dates[rows]
+
+        # forward filled values of the countries' rows and, for every block, the number of leading NaNs before
+        # the fill, its last value (NaN while it has none) and the value its leading NaNs take.
+        filled = raw[features].ffill()
+        self.filled, self.lead, self.last, self.carry = {}, {}, {}, {}
+        for col in features:
+            raw_values = raw[col].to_numpy(dtype='float64', na_value=np.nan)
+            values = filled[col].to_numpy(dtype='float64', na_value=np.nan)
+            self.filled[col] = values[rows]
+            self.lead[col] = _leading_nans(raw_values, starts, stops)
+            self.last[col] = np.where(self.lead[col] < self.lengths, values[stops - 1], np.nan)
+            self.carry[col] = _carries(self.last[col])
+
+        n_kept, n_rows = len(self.kept), len(rows)
+        state = ['corrected', 'weekly', 'body_start', 'body_stop', 'body_top_10', 'top_10_mean',
+                 'running_max', 'rest_decrease', 'zeros']
+        for name in state:
+            setattr(self, name, {})
+        for col in self.corrected_features:
+            self.corrected[col] = np.full(n_rows, np.nan)
+            if kind == 'cd':
+                self.weekly[col] = np.full(n_rows, np.nan)
+                self.body_start[col] = np.zeros(n_kept, dtype=np.int64)
+                self.body_stop[col] = np.zeros(n_kept, dtype=np.int64)
+                self.body_top_10[col] = np.full((n_kept, 10), np.nan)
+                self.top_10_mean[col] = np.full(n_kept, np.nan)
+            else:
+                self.running_max[col] = np.full(n_kept, np.nan)
+                self.rest_decrease[col] = np.full(n_kept, -1)
+                self.zeros[col] = np.zeros(n_kept, dtype=np.int64)
+            every = np.ones(n_kept, dtype=bool)
+            self._correct(col, np.zeros(n_kept, dtype=np.int64), self.lead[col][self.kept], every, every)
+
+    def update(self, new_tb):
+        new_countries = new_tb.index.get_level_values('country')
+        blocks = pd.Index(self.countries).get_indexer(new_countries)
+        if (blocks < 0).any():
+            raise ValueError(f"new country '{new_countries[blocks < 0][0]}' needs a full recompute")
+        dates = new_tb.index.get_level_values('date').to_numpy()
+        order = np.lexsort((dates, blocks))
+        blocks, dates = blocks[order], dates[order]
+
+        # first new row of each new row's block, and the last new row of each block.
+        first = np.searchsorted(blocks, blocks)
+        is_first = first == np.arange(len(blocks))
+        is_last = np.append(blocks[1:] != blocks[:-1], True)[:len(blocks)]
+        late = dates <= np.where(is_first, self.last_dates[blocks], np.roll(dates, 1))
+        if late.any():
+            raise ValueError(f"new rows of '{self.countries[blocks[np.argmax(late)]]}' must be dated after its last row")
+        self.last_dates[blocks[is_last]] = dates[is_last]
+
+        # the countries' new rows are inserted at the end of their block.
+        n_old = self.lengths[self.kept]
+        kept_rows = self.kept_index[blocks] >= 0
+        positions = np.cumsum(n_old)[self.kept_index[blocks[kept_rows]]]
+        self.lengths = self.lengths + np.bincount(blocks, minlength=len(self.countries))
+        n = self.lengths[self.kept]
+        starts = np.cumsum(n) - n
+        self.dates = np.insert(self.dates, positions, dates[kept_rows])
+
+        for col in self.features:
+            # forward fill: the new rows of a block take its last value, and its leading NaNs (new rows included,
+            # while it has no value) the value carried from the blocks before it.
+            values = new_tb[col].to_numpy(dtype='float64', na_value=np.nan)[order]
+            own = _ffill_segments(values, first, self.last[col][blocks])
+            self.last[col][blocks[is_last]] = own[is_last]
+            lead_old = self.lead[col][self.kept]
+            self.lead[col] = self.lead[col] + np.bincount(blocks, weights=np.isnan(own), minlength=len(self.countries)).astype(np.int64)
+            carry_old = self.carry[col][self.kept]
+            self.carry[col] = _carries(self.last[col])
+            carry = self.carry[col][self.kept]
+            carry_changed = ~_same_values(carry, carry_old)
+
+            filled = np.insert(self.filled[col], positions, np.where(np.isnan(own), self.carry[col][blocks], own)[kept_rows])
+            head = np.flatnonzero(carry_changed & (lead_old > 0))
+            filled[_ranges(starts[head], starts[head] + lead_old[head])] = np.repeat(carry[head], lead_old[head])
+            self.filled[col] = filled
+
+            if col in self.corrected_features:
+                full = self.lead[col][self.kept] != lead_old
+                self._correct(col, n_old, lead_old, carry_changed, full, positions)
+
+    # corrections of the blocks after rows were appended to their n_old previous rows and/or their leading
+    # NaNs took a new value (carry_changed); full: the blocks to recompute from scratch.
+    # positions: where the new rows were inserted in the flat arrays (None when there are none).
+    def _correct(self, col, n_old, lead_old, carry_changed, full, positions = None):
+        if positions is not None:
+            self.corrected[col] = np.insert(self.corrected[col], positions, np.nan)
+        if self.kind == 'cd':
+            if positions is not None:
+                self.weekly[col] = np.insert(self.weekly[col], positions, np.nan)
+            self._correct_cases_deaths(col, n_old, lead_old, carry_changed, full)
+        else:
+            self._correct_nonzeros(col, n_old, lead_old, carry_changed, full)
+
+    def _correct_cases_deaths(self, col, n_old, lead_old, carry_changed, full):
+        filled, weekly, corrected = self.filled[col], self.weekly[col], self.corrected[col]
+        lead, n = self.lead[col][self.kept], self.lengths[self.kept]
+        starts = np.cumsum(n) - n
+
+        # short histories: the body (and the first weekly windows) weren't settled yet.
+        full = full | (n_old < lead + 11 + 6)
+        head = carry_changed & (lead > 0) & ~full
+        grown = (n > n_old) & ~full
+
+        # weekly reporting: a change to the leading rows only reaches the rows before the body, new rows
+        # only reach the rows from n_old - 6 on. Each segment of rows is corrected as a block of its own.
+        body_start, body_stop = self.body_start[col], self.body_stop[col]
+        f, h, g = np.flatnonzero(full), np.flatnonzero(head), np.flatnonzero(grown)
+        segment_blocks = np.concatenate((f, h, g))
+        segment_from = np.concatenate((np.zeros(len(f) + len(h), dtype=np.int64), np.maximum(0, n_old[g] - 17)))
+        segment_to = np.concatenate((n[f], np.minimum(body_start[h] + 6, n[h]), n[g]))
+        write_from = np.concatenate((np.zeros(len(f) + len(h), dtype=np.int64), np.maximum(0, n_old[g] - 6)))
+        write_to = np.concatenate((n[f], body_start[h], n[g]))
+
+        rows = _ranges(starts[segment_blocks] + segment_from, starts[segment_blocks] + segment_to)
+        x = filled[rows]
+        segment_stops = np.cumsum(segment_to - segment_from)
+        segment_starts = segment_stops - (segment_to - segment_from)
+        _weekly_reporting_blocks(x, segment_starts, segment_stops)
+        written = _ranges(segment_starts + write_from - segment_from, segment_starts + write_to - segment_from)
+        written_blocks = np.repeat(segment_blocks, write_to - write_from)
+        written = rows[written], x[written]
+        weekly[written[0]] = written[1]
+
+        # anomalous spike: the body rows (from lead + 11 to the last 6 rows) change neither with the leading
+        # NaNs nor with new rows, so only their top 10 is kept; rows that settled into the body join it.
+        new_start = np.where(full, np.minimum(lead + 11, n), body_start)
+        new_stop = np.where(full, np.maximum(new_start, n - 6), np.maximum(body_stop, n - 6))
+        joined = np.flatnonzero(full | (new_stop > body_stop))
+        join_from = np.where(full, new_start, body_stop)[joined]
+        kept_top = joined[~full[joined]]
+        values = np.concatenate((weekly[_ranges(starts[joined] + join_from, starts[joined] + new_stop[joined])],
+                                 self.body_top_10[col][kept_top].ravel()))
+        groups = np.concatenate((np.repeat(joined, new_stop[joined] - join_from), np.repeat(kept_top, 10)))
+        self.body_top_10[col][joined] = _top_10_groups(values, groups, len(n))[joined]
+        self.body_start[col], self.body_stop[col] = new_start, new_stop
+
+        # top-10 mean: the body's top 10 plus the rows around it.
+        a = np.flatnonzero(full | head | grown)
+        values = np.concatenate((weekly[_ranges(starts[a], starts[a] + new_start[a])],
+                                 weekly[_ranges(starts[a] + new_stop[a], starts[a] + n[a])],
+                                 self.body_top_10[col][a].ravel()))
+        groups = np.concatenate((np.repeat(a, new_start[a]), np.repeat(a, n[a] - new_stop[a]), np.repeat(a, 10)))
+        top_10_mean = _top_10_means(_top_10_groups(values, groups, len(n)))[a]
+        whole = a[full[a] | ~_same_values(top_10_mean, self.top_10_mean[col][a])]
+        self.top_10_mean[col][a] = top_10_mean
+
+        # the whole blocks whose top-10 mean changed, the rewritten weekly rows of the others.
+        in_whole = np.zeros(len(n), dtype=bool)
+        in_whole[whole] = True
+        others = ~in_whole[written_blocks]
+        spiked = np.concatenate((_ranges(starts[whole], starts[whole] + n[whole]), written[0][others]))
+        spiked_blocks = np.concatenate((np.repeat(whole, n[whole]), written_blocks[others]))
+        mean = self.top_10_mean[col][spiked_blocks]
+        values = weekly[spiked]
+        corrected[spiked] = np.where(values > 5 * mean, mean, values)  # _apply_spike, with each row's block mean
+
+    def _correct_nonzeros(self, col, n_old, lead_old, carry_changed, full):
+        filled, corrected = self.filled[col], self.corrected[col]
+        lead, n, carry = self.lead[col][self.kept], self.lengths[self.kept], self.carry[col][self.kept]
+        starts = np.cumsum(n) - n
+
+        # running maximum and first decrease of the rows after the leading NaNs: over all of them for the
+        # blocks recomputed in full, over the new rows (from the kept running maximum) for the others.
+        f, g = np.flatnonzero(full), np.flatnonzero((n > n_old) & ~full)
+        segment_blocks = np.concatenate((f, g))
+        segment_from = np.concatenate((lead[f], n_old[g]))
+        lengths = n[segment_blocks] - segment_from
+        segment_starts = np.cumsum(lengths) - lengths
+        x = filled[_ranges(starts[segment_blocks] + segment_from, starts[segment_blocks] + n[segment_blocks])]
+        initial = np.concatenate((np.full(len(f), np.nan), self.running_max[col][g]))
+        running_max = np.fmax(_accumulate_segments(np.fmax, x, np.repeat(segment_starts, lengths)), np.repeat(initial, lengths))
+
+        hits = np.flatnonzero(x < running_max)
+        segments, first_hit = np.unique(np.repeat(np.arange(len(segment_blocks)), lengths)[hits], return_index=True)
+        decrease = np.full(len(segment_blocks), -1)
+        decrease[segments] = hits[first_hit] - segment_starts[segments] + segment_from[segments]
+        last_max = initial.copy()
+        last_max[lengths > 0] = running_max[(segment_starts + lengths - 1)[lengths > 0]]
+        self.running_max[col][segment_blocks] = last_max
+        rest_decrease = self.rest_decrease[col]
+        rest_decrease[f] = decrease[:len(f)]
+        rest_decrease[g] = np.where(rest_decrease[g] < 0, decrease[len(f):], rest_decrease[g])
+
+        # the leading NaNs hold the carried value: the first row after them decreases when it is below it.
+        has_rest = lead < n
+        first_value = np.full(len(n), np.nan)
+        first_value[has_rest] = filled[(starts + lead)[has_rest]]
+        zeros = np.maximum(np.where((lead > 0) & (first_value < carry), lead, rest_decrease), 0)
+
+        # rows before the first decrease are 0: rewrite the rows between the old and new first decrease, the
+        # leading NaNs that took a new value, the new rows, and the blocks recomputed in full.
+        zeros_old = self.zeros[col]
+        h = np.flatnonzero(carry_changed & (lead_old > 0) & ~full)
+        z = np.flatnonzero(~full)
+        low, high = np.minimum(zeros_old, zeros)[z], np.maximum(zeros_old, zeros)[z]
+        rows = np.concatenate((_ranges(starts[f], starts[f] + n[f]), _ranges(starts[h], starts[h] + lead_old[h]),
+                               _ranges(starts[z] + low, starts[z] + high), _ranges(starts[g] + n_old[g], starts[g] + n[g])))
+        blocks = np.concatenate((np.repeat(f, n[f]), np.repeat(h, lead_old[h]), np.repeat(z, high - low), np.repeat(g, n[g] - n_old[g])))
+        corrected[rows] = np.where(rows - starts[blocks] < zeros[blocks], 0, filled[rows])
+        self.zeros[col] = zeros
+
+    # the processed frame, as basic_processing and the corrections give it for the full table.
+    def frame(self):
+        n = self.lengths[self.kept]
+        table_starts = (np.cumsum(self.lengths) - self.lengths)[self.kept]
+        columns = {'country': pd.array(self.countries, dtype=self.dtypes['country']).take(np.repeat(self.kept, n)),
+                   'date': self.dates}
+        for col in self.features:
+            columns[col] = self.corrected[col] if col in self.corrected else self.filled[col]
+        df = pd.DataFrame(columns, index=pd.Index(_ranges(table_starts, table_starts + n)), copy=True)  # no memory shared with the state
+        recast = {col: self.dtypes[col] for col in ['date'] + self.features if df[col].dtype != self.dtypes[col]}
+        return df.astype(recast) if recast else df
+
+
+# concatenated np.arange(start, stop) of every pair.
+def _ranges(starts, stops):
+    lengths = stops - starts
+    return np.arange(lengths.sum(), dtype=np.int64) + np.repeat(starts - (np.cumsum(lengths) - lengths), lengths)
+
+
+# number of leading NaNs of every block values[starts[b]:stops[b]].
+def _leading_nans(values, starts, stops):
+    if len(starts) == 0:
+        return np.zeros(0, dtype=np.int64)
+    first_valid = np.minimum.reduceat(np.where(np.isnan(values), len(values), np.arange(len(values))), starts)
+    return np.minimum(first_valid, stops) - starts
+
+
+# ufunc.accumulate within each segment of values (first: the position of the first value of each value's
+# segment), for all the segments at once: the partial results are combined over doubling distances.
+def _accumulate_segments(ufunc, values, first):
+    out = values.copy()
+    positions = np.arange(len(values))
+    step = 1
+    while (positions - step >= first).any():
+        inside = np.flatnonzero(positions - step >= first)
+        out[inside] = ufunc(out[inside], out[inside - step])
+        step *= 2
+    return out
+
+
+# forward fill within each segment of values (first, as in _accumulate_segments), each segment starting from
+# its value of carry (one per value).
+def _ffill_segments(values, first, carry):
+    last_valid = _accumulate_segments(np.maximum, np.where(np.isnan(values), -1, np.arange(len(values))), first)
+    return np.where(last_valid >= 0, values[np.maximum(last_valid, 0)], carry)
+
+
+# value carried into each block by the forward fill: the last value of the blocks before it (NaN for the first).
+def _carries(last):
+    last_valid = np.maximum.accumulate(np.where(np.isnan(last), -1, np.arange(len(last))))
+    filled = np.where(last_valid >= 0, last[np.maximum(last_valid, 0)], np.nan)
+    return np.concatenate(([np.nan], filled[:-1]))
+
+
+# the 10 largest non-NaN values of each group (values with groups == g), in descending order, one row per
+# group of a (n_groups, 10) matrix padded with NaN.
+def _top_10_groups(values, groups, n_groups):
+    valid = ~np.isnan(values)
+    values, groups = values[valid], groups[valid]
+    order = np.lexsort((-values, groups))
+    values, groups = values[order], groups[order]
+    rank = np.arange(len(groups)) - np.searchsorted(groups, groups)
+    top = rank < 10
+    top_10 = np.full((n_groups, 10), np.nan)
+    top_10[groups[top], rank[top]] = values[top]
+    return top_10
+
+
+# _top_10_mean of each row of a _top_10_groups matrix.
+def _top_10_means(top_10):
+    count = (~np.isnan(top_10)).sum(axis=1)
+    with np.errstate(invalid='ignore'):
+        return np.round(np.where(np.isnan(top_10), 0, top_10).sum(axis=1) / count)
+
+
+def _same_values(a, b):
+    return (a == b) | (np.isnan(a) & np.isnan(b))
+
+
+# Wide panel
+#--------------------------------
+# The analysis and plotting functions look up one country's series at a time. Rather than filtering
+# or pivoting the long tables for every lookup, both tables are pivoted once into a date x country
+# matrix per feature, with a date -> row and country -> column index.
+class CovidPanel:
+
+    def __init__(self, dates, countries, values):
+        self.dates = dates  # DatetimeIndex, one row per date
+        self.countries = countries  # Index, one column per country
+        self.values = values  # feature -> 2-D array (dates x countries), NaN where there is no data
+        self.date_index = {date: i for i, date in enumerate(dates)}
+        self.country_index = {country: j for j, country in enumerate(countries)}
+
+    def features(self):
+        return list(self.values)
+
+    # one country's time series of a feature (raises KeyError for an unknown country, like a pivot).
+    def series(self, feature, country):
+        return pd.Series(self.values[feature][:, self.country_index[country]], index=self.dates, name=country)
+
+    # one date's values of a feature, for every country.
+    def row(self, feature, date):
+        return pd.Series(self.values[feature][self.date_index[pd.Timestamp(date)]], index=self.countries, name=date)
+
+    # the whole date x country matrix of a feature, as df.pivot(index='date', columns='country') would give it.
+    def frame(self, feature):
+        return pd.DataFrame(self.values[feature], index=self.dates, columns=self.countries)
+
+
+# build the panel from the processed tables (every column other than 'country' and 'date' becomes a feature,
+# plus new_cases_display when the tables have new_cases).
+def build_panel(*dfs):
+    dates = pd.DatetimeIndex(pd.to_datetime(pd.concat([df['date'] for df in dfs]).unique())).sort_values()
+    countries = pd.Index(pd.concat([df['country'] for df in dfs]).unique())
+    if isinstance(countries, pd.CategoricalIndex):
+        countries = countries.astype(countries.categories.dtype)  # compact frames
+
+    values = {}
+    for df in dfs:
+        rows = dates.get_indexer(pd.to_datetime(df['date']))
+        cols = countries.get_indexer(df['country'])
+        for feature in df.columns.drop(['country', 'date']):
+            matrix = np.full((len(dates), len(countries)), np.nan)
+            matrix[rows, cols] = df[feature].to_numpy(dtype='float64', na_value=np.nan)
+            values[feature] = matrix
+    if 'new_cases' in values:
+        values['new_cases_display'] = new_cases_display(values['new_cases'], dates)
+    return CovidPanel(dates, countries, values)
+
+
+# Threshold crossing index
+#--------------------------------
+# First date a country's series is at or above a threshold, and last date it is at or below one, for any
+# threshold, by binary search. The first date at or above X is the first date its running maximum is, and the
+# last date at or below X the last date its suffix minimum (minimum of the values from that date on) is; both
+# are sorted, whether or not the series is monotone, so each query is a searchsorted per country.
+# NaNs are skipped, as comparisons with them are false.
+class CrossingIndex:
+
+    def __init__(self, dates, countries, values):
+        self.dates = dates
+        self.countries = countries
+        with np.errstate(invalid='ignore'):
+            self.running_max = np.nan_to_num(np.fmax.accumulate(values, axis=0), nan=-np.inf)
+            self.suffix_min = np.nan_to_num(np.fmin.accumulate(values[::-1], axis=0)[::-1], nan=np.inf)
+
+    # row of the first date at or above (strict: above) each threshold, len(dates) when there is none.
+    def first_rows(self, thresholds, strict = False):
+        side = 'right' if strict else 'left'
+        return self._search(self.running_max, thresholds, side)
+
+    # row of the last date at or below (strict: below) each threshold, -1 when there is none.
+    def last_rows(self, thresholds, strict = False):
+        side = 'left' if strict else 'right'
+        return self._search(self.suffix_min, thresholds, side) - 1
+
+    # (thresholds x countries) rows found by binary search in each country's sorted column.
+    def _search(self, sorted_values, thresholds, side):
+        thresholds = np.atleast_1d(np.asarray(thresholds, dtype='float64'))
+        rows = np.empty((len(thresholds), sorted_values.shape[1]), dtype=int)
+        for j in range(sorted_values.shape[1]):
+            rows[:, j] = np.searchsorted(sorted_values[:, j], thresholds, side=side)
+        return rows
+
+    def _to_dates(self, rows):
+        valid = (rows >= 0) & (rows < len(self.dates))
+        dates = np.full(rows.shape, np.datetime64('NaT'), dtype=self.dates.values.dtype)
+        dates[valid] = self.dates.values[rows[valid]]
+        return dates
+
+    # country -> first date at or above (strict: above) threshold, NaT when it never gets there.
+    def first_date_at_or_above(self, threshold, strict = False):
+        return pd.Series(self._to_dates(self.first_rows(threshold, strict))[0], index=self.countries)
+
+    # country -> last date at or below (strict: below) threshold, NaT when it never is.
+    def last_date_at_or_below(self, threshold, strict = False):
+        return pd.Series(self._to_dates(self.last_rows(threshold, strict))[0], index=self.countries)
+
+    # threshold x country crossing dates, for kind 'first_at_or_above' or 'last_at_or_below'.
+    def sweep(self, thresholds, kind = 'first_at_or_above', strict = False):
+        if kind == 'first_at_or_above':
+            rows = self.first_rows(thresholds, strict)
+        elif kind == 'last_at_or_below':
+            rows = self.last_rows(thresholds, strict)
+        else:
+            raise ValueError(f"unknown crossing kind '{kind}'")
+        return pd.DataFrame(self._to_dates(rows), index=pd.Index(np.atleast_1d(thresholds), name='threshold'),
+                            columns=self.countries)
+
+
+# crossing index of one feature of the panel (for any country subset, select its columns afterwards).
+def build_crossing_index(panel, feature = 'people_fully_vaccinated_per_hundred'):
+    return CrossingIndex(panel.dates, panel.countries, panel.values[feature])
+
+
+# Cases as shown on the map: the day's new cases, or, on days with zero cases, the average of the
+# last 7 days (today included, NaN ignored). new_cases is one series, or a matrix with one row per date;
+# dates are the (sorted) dates of its rows, which need not be consecutive.
+# The 7-day sums are added in date order, so the averages are exactly np.nanmean of each window.
+def new_cases_display(new_cases, dates):
+    new_cases = np.asarray(new_cases, dtype='float64')
+    dates = pd.DatetimeIndex(dates)
+    rows = np.arange(len(dates))
+    window_start = dates.searchsorted(dates - pd.Timedelta(days=6))
+    if new_cases.ndim == 2:
+        rows, window_start = rows[:, None], window_start[:, None]
+
+    total = np.zeros(new_cases.shape)
+    count = np.zeros(new_cases.shape)
+    for days_back in range(6, -1, -1):
+        previous = np.roll(new_cases, days_back, axis=0)
+        in_window = (rows - days_back >= window_start) & ~np.isnan(previous)
+        total += np.where(in_window, previous, 0)
+        count += in_window
+
+    display = new_cases.copy()
+    zero = new_cases == 0
+    with np.errstate(invalid='ignore'):
+        display[zero] = total[zero] / count[zero]
+    return display
+
+
+# Compact layout
+#--------------------------------
+# The processed frames hold the country names as strings and every metric as float64. In the compact layout
+#  - 'country' is a categorical, with the same categories (so the same codes) in every frame,
+#  - 'date' is datetime64,
+#  - each metric is int32 when its values are whole numbers without gaps, float32 when that is lossless,
+#    and float64 otherwise. (Nullable Int32 is not used: its missing value pd.NA cannot be compared or
+#    tested with if, which the plotting code does with single values.)
+# The values are unchanged, so every function of statistical_analysis and plot_data gives the same results.
+def compact_frames(*dfs):
+    categories = pd.Index(pd.concat([df['country'].astype(str) for df in dfs]).unique())
+    compact = []
+    for df in dfs:
+        df = df.copy()
+        df['country'] = pd.Categorical(df['country'].astype(str), categories=categories)
+        df['date'] = pd.to_datetime(df['date'])
+        for col in df.columns.drop(['country', 'date']):
+            df[col] = _compact_column(df[col].to_numpy(dtype='float64', na_value=np.nan))
+        compact.append(df)
+    return tuple(compact)
+
+
+# smallest dtype that holds the values exactly.
+def _compact_column(values):
+    if not np.isnan(values).any() and np.array_equal(values, np.round(values)) \
+            and np.abs(values).max(initial=0) <= np.iinfo(np.int32).max:
+        return values.astype(np.int32)
+    values_32 = values.astype(np.float32)
+    if np.array_equal(values_32.astype(np.float64), values, equal_nan=True):
+        return values_32
+    return values
+
+
+# memory used by each column (strings included) before and after, in MB, with the total in the last row.
+def memory_report(df, compact_df):
+    report = pd.DataFrame({'dtype': df.dtypes.astype(str),
+                           'MB': df.memory_usage(index=False, deep=True) / 1e6,
+                           'compact dtype': compact_df.dtypes.astype(str),
+                           'compact MB': compact_df.memory_usage(index=False, deep=True) / 1e6})
+    report.loc['total'] = ['', report['MB'].sum(), '', report['compact MB'].sum()]
+    return report
 
 
 # List of non-countries that appear in data.